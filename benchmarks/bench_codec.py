@@ -0,0 +1,27 @@
+'''Compression ratio and throughput of encode_readings()/decode_readings() on synthetic readings.
+
+Run with: python -m benchmarks.bench_codec'''
+from timeit import Timer
+import zlib
+
+from mysotherm.mysa_stuff import encode_readings, decode_readings
+from .synthetic import readings_batch
+
+
+def main():
+    n = 2880  # one day of 30-second readings
+    for ver in (0, 1, 3):
+        raw = readings_batch(ver, n)
+        enc = encode_readings(raw)
+        assert decode_readings(enc) == raw
+        varints = len(zlib.decompress(enc))
+        ecount, etotal = Timer(lambda: encode_readings(raw)).autorange()
+        dcount, dtotal = Timer(lambda: decode_readings(enc)).autorange()
+        print(f'v{ver}: {n} readings, {len(raw)} -> {len(enc)} bytes ({len(raw) / len(enc):.1f}x; '
+              f'{varints} bytes before zlib, {len(raw) / varints:.1f}x), '
+              f'zlib alone {len(raw) / len(zlib.compress(raw, 9)):.1f}x; '
+              f'encode {n * ecount / etotal / 1e3:.0f}k readings/s, decode {n * dcount / dtotal / 1e3:.0f}k readings/s')
+
+
+if __name__ == '__main__':
+    main()
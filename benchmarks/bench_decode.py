@@ -0,0 +1,42 @@
+'''Cost per message of parsing and decoding MQTT message payloads: the old path
+(json.loads into util.slurpy objects, plus a deepcopy of the result in case the
+message isn't understood), versus plain dicts with the standard library parser
+and with orjson (if installed).
+
+Run with: python -m benchmarks.bench_decode'''
+from copy import deepcopy
+import json
+from timeit import Timer
+
+from mysotherm import messages
+from mysotherm.util import slurpy
+from .synthetic import sample_messages
+
+
+def per_call_us(fn) -> float:
+    count, total = Timer(fn).autorange()
+    return min([total] + Timer(fn).repeat(3, count)) / count * 1e6
+
+
+def main():
+    paths = {
+        'slurpy+deepcopy': lambda p: deepcopy(json.loads(p, object_hook=slurpy, strict=False)),
+        'json': lambda p: json.loads(p, strict=False),
+    }
+    if messages.orjson is not None:
+        paths['orjson'] = messages.orjson.loads
+    else:
+        print('(orjson not installed)')
+
+    for name, (topic, payload) in sample_messages().items():
+        if name == 'MsgType 0 status':
+            continue
+        did, subtopic = topic.split('/')[-2:]
+        times = {path: per_call_us(lambda: messages.decode(did, subtopic, fn(payload))) for path, fn in paths.items()}
+        base = times['slurpy+deepcopy']
+        print(f'{name} ({len(payload)} bytes): ' + ', '.join(
+            f'{path} {us:.2f} µs' + ('' if us == base else f' ({base / us:.1f}x)') for path, us in times.items()))
+
+
+if __name__ == '__main__':
+    main()
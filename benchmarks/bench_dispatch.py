@@ -0,0 +1,51 @@
+'''Cost per message of classifying and decoding MQTT messages with mysotherm.messages.
+
+Also checks that registering many more message types doesn't slow down dispatch of
+the common ones.
+
+Run with: python -m benchmarks.bench_dispatch'''
+import json
+from timeit import Timer
+
+from mysotherm import messages
+from .synthetic import sample_messages
+
+
+def per_call_us(fn) -> float:
+    count, total = Timer(fn).autorange()
+    return min([total] + Timer(fn).repeat(3, count)) / count * 1e6
+
+
+def run(samples):
+    results = {}
+    for name, (topic, payload) in samples.items():
+        did, subtopic = topic.split('/')[-2:]
+        j = json.loads(payload)
+        m = messages.decode(did, subtopic, j)
+        assert type(m) is not messages.Message, f'{name} not understood'
+        results[name] = (type(m).__name__,
+                         per_call_us(lambda: messages.decode(did, subtopic, j)),
+                         per_call_us(lambda: messages.decode(did, subtopic, j).describe()))
+    return results
+
+
+def main():
+    samples = sample_messages()
+    print(f'{len(messages._registry)} registered message types:')
+    for name, (cls, decode, describe) in run(samples).items():
+        print(f'  {name:<18} -> {cls:<16} decode {decode:5.2f} µs, decode+describe {describe:6.2f} µs')
+
+    extra = [('msg', 1000 + n, sub) for n in range(500) for sub in ('in', 'out', 'batch')]
+    for key in extra:
+        messages._registry[key] = messages.Message
+    try:
+        print(f'With {len(messages._registry)} registered message types:')
+        for name, (cls, decode, _) in run({k: v for k, v in samples.items() if 'status' in k}).items():
+            print(f'  {name:<18} -> {cls:<16} decode {decode:5.2f} µs')
+    finally:
+        for key in extra:
+            del messages._registry[key]
+
+
+if __name__ == '__main__':
+    main()
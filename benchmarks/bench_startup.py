@@ -0,0 +1,71 @@
+'''Import time of the command-line entry points, against a startup-time budget.
+
+`mysotherm -W` and `liten-up -R` only need the HTTP/auth modules, so the modules that are
+only used for MQTT must not be imported eagerly.
+
+Run with: python -m benchmarks.bench_startup [--budget-ms MS] [--runs N]
+Exits with status 1 if over budget.'''
+from argparse import ArgumentParser
+import re
+import subprocess
+import sys
+
+ENTRY_POINTS = {
+    'mysotherm -W': 'mysotherm.__main__',
+    'liten-up -R': 'mysotherm.liten_up',
+}
+
+MQTT_ONLY = ('asyncio', 'websockets.asyncio', 'websockets.exceptions', 'mqttpacket.v311', 'mysotherm.mqtt', 'numpy')
+"""Modules which should not be (non-lazily) loaded on the fast-startup paths. (Their parent
+packages get imported by lazy_import, but those are small.)"""
+
+_importtime_re = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+_probe = '''
+import sys, importlib.util
+import {0}
+print(' '.join(k for k, m in sys.modules.items() if not isinstance(m, importlib.util._LazyModule)))
+'''
+
+
+def measure(module: str):
+    '''Returns (cumulative import time in µs, {direct import: µs}, set of non-lazily loaded modules)'''
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', _probe.format(module)],
+                       capture_output=True, text=True, check=True)
+    total, children = None, {}
+    for line in p.stderr.splitlines():
+        if m := _importtime_re.match(line):
+            depth = len(m.group(3)) // 2
+            if depth == 0 and m.group(4) == module:
+                total = int(m.group(2))
+            elif depth == 1 and total is None:
+                children[m.group(4)] = int(m.group(2))
+            elif depth == 0:
+                children.clear()
+    return total, children, set(p.stdout.split())
+
+
+def main(args=None):
+    p = ArgumentParser(description=__doc__.splitlines()[0])
+    # Just above the measured import time with MQTT-only modules loaded lazily (~320 ms, of which ~150-220 ms
+    # is boto3/botocore via mysotherm.aws and pycognito, which are needed for authentication anyway)
+    p.add_argument('-b', '--budget-ms', type=float, default=325, help='Startup budget per entry point (default %(default)s ms)')
+    p.add_argument('-n', '--runs', type=int, default=5, help='Best of N runs (default %(default)s)')
+    args = p.parse_args(args)
+
+    ok = True
+    for cmd, module in ENTRY_POINTS.items():
+        total, top, loaded = min((measure(module) for _ in range(args.runs)), key=lambda r: r[0])
+        eager = sorted(m for m in loaded if any(m == x or m.startswith(x + '.') for x in MQTT_ONLY))
+        over = total / 1e3 > args.budget_ms
+        ok &= not over and not eager
+        print(f'{cmd}: {total / 1e3:.0f} ms imports (budget {args.budget_ms:.0f} ms){"  OVER BUDGET" if over else ""}')
+        for name, us in sorted(top.items(), key=lambda kv: -kv[1])[:5]:
+            print(f'  {us / 1e3:6.1f} ms  {name}')
+        if eager:
+            print(f'  Eagerly imported MQTT-only modules: {", ".join(eager)}')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,31 @@
+'''Per-batch latency of translating v3 readings into v0 readings, as done by liten-up.
+
+Run with: python -m benchmarks.bench_transcode'''
+from timeit import Timer
+
+from mysotherm.mysa_stuff import MysaReading, MysaReadingV0, transcode_readings_v3_to_v0
+from .synthetic import readings_batch
+
+
+def transcode_via_objects(raw: bytes) -> bytes:
+    # What liten-up used to do: parse, rebuild as MysaReadingV0 objects, and re-pack
+    return b''.join(
+        bytes(MysaReadingV0(checksum=None, ver=0, **{
+            k: getattr(r, k) for k, v in r.__dataclass_fields__.items()
+            if k not in ('voltage', 'current', 'always0', 'ver', 'checksum')}))
+        for r in MysaReading.parse_readings(raw))
+
+
+def main():
+    for n in (1, 10, 40, 120):
+        raw = readings_batch(3, n)
+        assert transcode_readings_v3_to_v0(raw) == transcode_via_objects(raw)
+        print(f'{n:4d} readings/batch:', end='')
+        for name, f in (('objects', transcode_via_objects), ('bytes', transcode_readings_v3_to_v0)):
+            count, total = Timer(lambda: f(raw)).autorange()
+            print(f'  {name} {total / count * 1e6:8.1f} µs', end='')
+        print()
+
+
+if __name__ == '__main__':
+    main()
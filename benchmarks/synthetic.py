@@ -0,0 +1,53 @@
+'''Synthetic readings batches and MQTT messages, resembling those sent by Mysa devices, for benchmarks.'''
+from base64 import b64encode
+import json
+import random
+
+from mysotherm.mysa_stuff import _known_reading_vers
+
+
+def readings_batch(ver: int, n: int = 40, seed: int = 0, start: int = 1736700000) -> bytes:
+    '''n readings of version ver, about 30 s apart, with slowly-drifting temperatures'''
+    rnd = random.Random(seed)
+    cls = _known_reading_vers[ver]
+    temp, duty = 200, 0
+    out = []
+    for ii in range(n):
+        temp += rnd.choice((-1, 0, 0, 0, 1))
+        if rnd.random() < 0.05:
+            duty = 100 - duty
+        extra = {}
+        if ver in (1, 3):
+            extra['voltage'] = 240
+        if ver == 3:
+            extra.update(current=duty * 80, always0=b'\0\0\0')
+        out.append(bytes(cls(
+            ver=ver, ts=start + 30 * ii + rnd.randint(0, 1), sensor_t=temp / 10, ambient_t=(temp - 15) / 10,
+            setpoint_t=20.5, humidity=45 + rnd.randint(-1, 1), duty=duty,
+            on_ms=3000 if duty else 0, off_ms=0 if duty else 3000, heatsink_t=(temp + 50) / 10,
+            free_heap=rnd.randint(4000, 4100) * 10, rssi=-rnd.randint(55, 60), onoroff=int(bool(duty)),
+            checksum=None, checksum_good=True, unknown=None, **extra)))
+    return b''.join(out)
+
+
+def sample_messages(did: str = 'aabbccddeeff', user_id: str = '0f1e2d3c-4b5a-6978-8796-a5b4c3d2e1f0',
+                    ts: int = 1736700000) -> dict[str, tuple[str, bytes]]:
+    '''Realistic MQTT messages, by name, as (topic, payload)'''
+    src = {'ref': did, 'type': 1}
+    msgs = {
+        'msg 40 status': ('out', {'body': {'ambTemp': 16.7, 'dtyCycle': 1.0, 'hum': 48.0, 'stpt': 17.8},
+                                  'id': 7307458417261367308, 'msg': 40, 'src': src, 'time': ts, 'ver': '1.0'}),
+        'MsgType 0 status': ('out', {'ComboTemp': 20.93, 'Current': 0.0, 'Device': did, 'Humidity': 48.0,
+                                     'MainTemp': 17.15, 'MsgType': 0, 'SetPoint': 15.5, 'Stream': 1,
+                                     'ThermistorTemp': 0.0, 'Timestamp': ts}),
+        'msg 44 command': ('in', {'Timestamp': ts, 'body': {'cmd': [{'sp': 17, 'tm': -1}], 'type': 5, 'ver': 1},
+                                  'dest': src, 'id': ts * 1000 + 123, 'msg': 44, 'resp': 2,
+                                  'src': {'ref': user_id, 'type': 100}, 'time': ts, 'ver': '1.0'}),
+        'msg 44 response': ('out', {'body': {'state': {'br': {'a_b': 1, 'a_br': 100, 'i_br': 50, 'a_dr': 60, 'i_dr': 30},
+                                                       'ho': 1, 'lk': 0, 'md': 3, 'sp': 17.0}, 'success': 1, 'trig_src': 3, 'type': 5},
+                                    'id': 8262553741235416372, 'msg': 44, 'resp_id': ts * 1000 + 123, 'src': src,
+                                    'time': ts + 1, 'ver': '1.0'}),
+        'msg 3 readings': ('batch', {'body': {'readings': b64encode(readings_batch(3, 10, start=ts)).decode()},
+                                     'id': 1923582377123, 'msg': 3, 'src': src, 'time': ts + 300, 'ver': '1.0'}),
+    }
+    return {name: (f'/v1/dev/{did}/{sub}', json.dumps(j).encode()) for name, (sub, j) in msgs.items()}
@@ -1,29 +1,40 @@
 #!/bin/env python3
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime
 from itertools import chain
-from copy import deepcopy
-import base64
-import json
 import logging
 import os
 import struct
 import traceback
 from pprint import pprint
-from urllib.parse import urlparse, urlunparse, quote
+from sys import stderr
 from time import time, sleep
+from typing import Optional
 from uuid import uuid1
 
 import pytz
 import requests
-from websockets.sync.client import connect
-import mqttpacket.v311 as mqttpacket
 
-from .util import slurpy
+from .util import lazy_import, slurpy, StageTimer
 from . import mysa_stuff
-from .mysa_stuff import BASE_URL, MysaReading
+from .mysa_stuff import BASE_URL
+from . import messages
+from . import aws
 from .aws import boto3, botocore
-from .auth import authenticate, CONFIG_FILE
+from .auth import authenticate, configured_users, load_credentials, CONFIG_FILE
+from .archive import ReadingsArchive, ARCHIVE_DIR
+from .cache import DeviceCache, CACHE_FILE
+
+# Only needed for watching MQTT messages (or --all-users), so don't slow down --no-watch with them
+asyncio = lazy_import('asyncio')
+mqttpacket = lazy_import('mqttpacket.v311')
+mqtt = lazy_import(f'{__package__}.mqtt')
+recheck = lazy_import(f'{__package__}.recheck')
+twin = lazy_import(f'{__package__}.twin')
+metrics = lazy_import(f'{__package__}.metrics')
+profiling = lazy_import(f'{__package__}.profiling')
 
 
 logging.basicConfig(format='[%(levelname)s:%(name)s] %(asctime)s - %(message)s',
@@ -32,361 +43,373 @@ logger = logging.getLogger(__name__)
 
 def main(args=None):
     p = ArgumentParser()
-    p.add_argument('-u', '--user', help=f'Mysa username (default is first one configured in {CONFIG_FILE!r})')
+    x = p.add_mutually_exclusive_group()
+    x.add_argument('-u', '--user', help=f'Mysa username (default is first one configured in {CONFIG_FILE!r})')
+    x.add_argument('-a', '--all-users', action='store_true', help=f'Use all Mysa accounts configured in {CONFIG_FILE!r}, and watch all of them in one process')
     p.add_argument('-d', '--device', action='append',
                    type=lambda s: s.replace(':','').lower(), help='Specific device (MAC address); may be repeated')
     p.add_argument_group('Debugging options')
+    p.add_argument('-A', '--archive', metavar='DIR', nargs='?', const=ARCHIVE_DIR,
+                   help=f'Save raw readings received from devices into an archive (default directory {ARCHIVE_DIR!r}); query it with mysotherm-archive')
+    p.add_argument('--no-cache', action='store_true', help=f'Do not use the device metadata cache ({CACHE_FILE!r})')
+    p.add_argument('--refresh-cache', action='store_true', help='Refetch device serial numbers instead of using cached values')
     p.add_argument('-W', '--no-watch', action='store_true', help="Exit after printing status information, don't watch for realtime MQTT messages")
     p.add_argument('--dump-lots', action='store_true', help='Dump JSON from a whole bunch of endpoints.')
+    p.add_argument('--timings', action='store_true', help='Show how long each step of startup took, and which were on the critical path.')
     p.add_argument('--dump-token', action='store_true', help='Dump access token and cURL command.')
     p.add_argument('--check-readings', action='store_true', help='Check details of raw readings against status information.')
-    p.add_argument('--inject', default=[], action='append', help='After connecting to MQTT endpoint, send this publish packet (format is topic=JSON, and may be specified multiple times)')
+    p.add_argument('--inject', default=[], action='append', help='After connecting to MQTT endpoint, send this publish packet (format is topic=JSON, and may be specified multiple times; with --all-users, sent by the account which owns the device)')
+    p.add_argument('-K', '--shards', type=int, default=1, metavar='K', help='Spread devices over K MQTT connections (default %(default)s)')
+    p.add_argument('--shard-by', choices=('count', 'hash'), default='count',
+                   help='Partition devices evenly by count, or by hash of device ID (default %(default)s)')
+    p.add_argument('--subscribe-chunk', type=int, default=3, metavar='N', help='Maximum number of MQTT topics per SUBSCRIBE packet (default %(default)s)')
+    p.add_argument('--subscribe-window', type=int, default=4, metavar='N', help='Maximum number of SUBSCRIBE packets awaiting SUBACK at once (default %(default)s)')
+    p.add_argument('--serve-state', metavar='ADDR',
+                   help='Serve the current state of the devices (as updated by MQTT messages) as JSON over HTTP, at HOST:PORT or a Unix socket path')
+    p.add_argument('--metrics', metavar='ADDR',
+                   help='Serve metrics (Prometheus text format) over HTTP at /metrics, at HOST:PORT or a Unix socket path')
+    p.add_argument('--profile', action='store_true', help='Profile the MQTT watch loop with cProfile and tracemalloc (dumped along with stage timings on SIGUSR1, and on exit)')
     p.add_argument('--inject-dump-bin', action='store_true', help='After connecting to MQTT endpoint, tell all devices to dump their binary readings immediately.')
     args = p.parse_args(args)
+    if args.shards < 1:
+        p.error('--shards must be at least 1')
+
+    cache = None if args.no_cache else DeviceCache()
+    if args.all_users:
+        users = configured_users(CONFIG_FILE)
+        if not users:
+            p.error(f'Did not find any section named "mysa:USERNAME" in config file {CONFIG_FILE!r}')
+        accounts = asyncio.run(bootstrap_all(users, cache=cache, refresh_cache=args.refresh_cache, need_credentials=not args.no_watch))
+        if not accounts:
+            p.error('Could not log in to any Mysa account')
+    else:
+        try:
+            accounts = [bootstrap(args.user, cache=cache, refresh_cache=args.refresh_cache, need_credentials=not args.no_watch)]
+        except Exception as exc:
+            p.error(exc)
+
+    if cache is not None:
+        cache.save()
+
+    if args.device:
+        if (missing := set(args.device).difference(*(a.devices for a in accounts))):
+            p.error(f"Device ID(s) {', '.join(missing)} not found in your Mysa account{'s' if len(accounts) > 1 else ''}.")
+
+    if args.timings:
+        for acct in accounts:
+            print(f"Startup timings for Mysa account {acct.u.id_claims['cognito:username']}:", file=stderr)
+            print(acct.timer.report(), file=stderr)
+
+    for acct in accounts:
+        u = acct.u
+        acct.specific = args.device and [did for did in args.device if did in acct.devices]
+        if len(accounts) > 1:
+            print(f"Mysa account {u.id_claims['cognito:username']}:")
+            print("==============" + "=" * len(u.id_claims['cognito:username']))
+
+        if args.dump_token:
+            print("Cognito ID token:")
+            print("=================")
+            print(u.id_token)
+            print("Cognito ID claims:")
+            print("==================")
+            pprint(u.id_claims)
+            print("cURL template:")
+            print("==============")
+            print(f"curl -H 'authorization: {u.id_token}' '{BASE_URL}'")
+
+        if args.dump_lots:
+            print("GET /users | .json() | .User")
+            print("============================")
+            pprint(acct.user)
+            print("GET /devices | .json() | .DevicesObj")
+            print("====================================")
+            pprint(acct.devices)
+            print("GET /devices/state | .json() | .DeviceStatesObj")
+            print("===============================================")
+            pprint(acct.states)
+            print("GET /devices/firmware | .json() | .Firmware")
+            print("===========================================")
+            pprint(acct.firmware)
+            print("GET /homes | .json() | .Homes")
+            print("=============================")
+            pprint(acct.homes)
+
+        if acct.specific is None or acct.specific:
+            print_device_states(acct.devices, acct.states, acct.firmware, acct.specific)
+
+    if args.no_watch:
+        return
+
+    archive = args.archive and ReadingsArchive(args.archive)
+
+    print("Connecting to MQTT endpoint to watch real-time messages...")
+
+    for acct in accounts:
+        # Now we need to use these credentials to do a "SigV4 presigning" of the target URL that
+        # will be used for the HTTP->websockets connection: https://a3q27gia9qg3zy-ats.iot.us-east-1.amazonaws.com/mqtt
+        # Mysa is doing SigV4 in an odd (and potentially insecure) way, see comments in this function.
+        # This is redone for each (re)connection, since the signature is only valid for an hour.
+        acct.sign_mqtt_url = partial(mysa_stuff.sigv4_sign_mqtt_url, acct.cred)
 
-    bsess = boto3.session.Session(region_name=mysa_stuff.REGION)
+    # Let us touch the horrid boto3/AWS interfaces no more.
+
+    profiling.install(args.profile)
     try:
-        u = authenticate(args.user, CONFIG_FILE, bsess)
-    except Exception as exc:
-        p.error(exc)
+        asyncio.run(watch_all(args, [a for a in accounts if a.specific is None or a.specific], archive))
+    finally:
+        if args.profile:
+            profiling.dump()
+
+
+def bootstrap(username: Optional[str] = None, interactive: bool = True, timer: Optional[StageTimer] = None,
+              max_workers: int = 8, cache: Optional[DeviceCache] = None, refresh_cache: bool = False,
+              need_credentials: bool = True) -> slurpy:
+    '''Log in to one Mysa account, and fetch status info and AWS credentials for it.
+
+    Each account gets its own boto3 session, Cognito object and requests session, so that
+    multiple accounts can be bootstrapped (and their tokens refreshed) independently.
+
+    The REST queries and the cognito-identity credential exchange are independent of each
+    other, so they're issued concurrently, and the per-device IoT lookups are fanned out
+    over a pool of at most max_workers threads.
+
+    Device serial numbers are taken from the cache when possible, in which case the IoT lookups
+    (and, unless need_credentials is set, the AWS credentials needed for them) are skipped.'''
+    timer = timer or StageTimer()
+    with timer('boto3 session'):
+        bsess = boto3.session.Session(region_name=mysa_stuff.REGION)
+    with timer('authenticate'):
+        u = (authenticate if interactive else load_credentials)(username, CONFIG_FILE, bsess)
 
     assert u.token_type == 'Bearer'
     sess = requests.Session()
     sess.auth = mysa_stuff.auther(u)
     sess.headers.update(mysa_stuff.CLIENT_HEADERS)
 
-    if args.dump_token:
-        print("Cognito ID token:")
-        print("=================")
-        print(u.id_token)
-        print("Cognito ID claims:")
-        print("==================")
-        pprint(u.id_claims)
-        print("cURL template:")
-        print("==============")
-        print(f"curl -H 'authorization: {u.id_token}' '{BASE_URL}'")
-
-    # Fetch a bunch of status info
-    try:
-        user = (r := sess.get(f'{BASE_URL}/users')).json(object_hook=slurpy).User
-        homes = (r := sess.get(f'{BASE_URL}/homes')).json(object_hook=slurpy).Homes
-        devices = (r := sess.get(f'{BASE_URL}/devices')).json(object_hook=slurpy).DevicesObj
-        states = (r := sess.get(f'{BASE_URL}/devices/state')).json(object_hook=slurpy).DeviceStatesObj
-        firmware = (r := sess.get(f'{BASE_URL}/devices/firmware')).json(object_hook=slurpy).Firmware
-    except Exception:
-        assert not r.ok
-        p.error(f"Request for {r.url} failed: {r.status_code} {r.reason}")
-    # Have also seen:
-    #   GET /devices/capabilities (empty for me)
-    #   GET /devices/drstate (empty for me)
-    #   GET /homes, /homes/{home_uuid}, /users, /users/{user_uuid}, /schedules, etc (-> JSON)
-    #   PATCH /users/{user_uuid} (-> set app info)
-    #   POST /energy/setpoints/device/{device_id} (-> this is NOT setting the device setpoint, only reading it. Payload is {"PhoneTimezone": "America/Vancouver", "Scope": "Day","Timestamp": 1736700658}
-    #   POST /energy/device/{device_id} (-> reading the device energy usage and temp/humidity readings. Same payload.)
-    #   GET /devices/state/{device_id}
-
-    # Get AWS credentials with cognito-identity. These are needed both for
-    # the boto3 'iot' client object, as well as for MQTT.
-    cred = u.get_credentials(identity_pool_id=mysa_stuff.IDENTITY_POOL_ID)
-
-    # 1. Why does Mysa store the serial number in a whole separate API?
-    # 2. Below is the least-repetitive, sanest way to stuff arbitrary `botocore.credentials.Credentials`
-    #    into the boto3 session object. Naturally, it's undocumented in
-    #    https://boto3.amazonaws.com/v1/documentation/api/latest/guide/credentials.html
-    bsess._session._credentials = cred
-    iotc = bsess.client('iot')
-    for d in devices:
-        try:
-            ser = iotc.describe_thing(thingName=d)['attributes']['Serial']
-        except (botocore.exceptions.ClientError, KeyError):
-            logger.warn('Could not get serial number for device ID {d}')
-            ser = None
-        devices[d]._serial = ser
+    def fetch(path, key):
+        with timer(f'GET {path}'):
+            r = sess.get(f'{BASE_URL}{path}')
+            try:
+                return r.json(object_hook=slurpy)[key]
+            except Exception:
+                assert not r.ok
+                raise RuntimeError(f"Request for {r.url} failed: {r.status_code} {r.reason}")
+
+    def get_credentials():
+        # Get AWS credentials with cognito-identity. These are needed both for
+        # the boto3 'iot' client object, as well as for MQTT.
+        with timer('cognito-identity credentials'):
+            return u.get_credentials(identity_pool_id=mysa_stuff.IDENTITY_POOL_ID)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # Fetch a bunch of status info
+        fcred = pool.submit(get_credentials) if need_credentials else None
+        user, homes, devices, states, firmware = [f.result() for f in [
+            pool.submit(fetch, '/users', 'User'),
+            pool.submit(fetch, '/homes', 'Homes'),
+            pool.submit(fetch, '/devices', 'DevicesObj'),
+            pool.submit(fetch, '/devices/state', 'DeviceStatesObj'),
+            pool.submit(fetch, '/devices/firmware', 'Firmware'),
+        ]]
+        # Have also seen:
+        #   GET /devices/capabilities (empty for me)
+        #   GET /devices/drstate (empty for me)
+        #   GET /homes, /homes/{home_uuid}, /users, /users/{user_uuid}, /schedules, etc (-> JSON)
+        #   PATCH /users/{user_uuid} (-> set app info)
+        #   POST /energy/setpoints/device/{device_id} (-> this is NOT setting the device setpoint, only reading it. Payload is {"PhoneTimezone": "America/Vancouver", "Scope": "Day","Timestamp": 1736700658}
+        #   POST /energy/device/{device_id} (-> reading the device energy usage and temp/humidity readings. Same payload.)
+        #   GET /devices/state/{device_id}
+
+        username = u.id_claims['cognito:username']
+        if cache is None:
+            misses = list(devices)
+        else:
+            if refresh_cache:
+                cache.invalidate(username)
+            misses = []
+            for d in devices:
+                if (cached := cache.get(username, d)) is not None and 'Serial' in cached:
+                    devices[d]._serial = cached['Serial']
+                else:
+                    misses.append(d)
+            logger.debug(f'Device cache for {username!r}: {len(devices) - len(misses)} hits, {len(misses)} misses')
+
+        cred = None
+        if fcred or misses:
+            cred = (fcred or pool.submit(get_credentials)).result()
+
+        if misses:
+            # Why does Mysa store the serial number in a whole separate API?
+            if u.use_boto3_clients:
+                # Below is the least-repetitive, sanest way to stuff arbitrary `botocore.credentials.Credentials`
+                # into the boto3 session object. Naturally, it's undocumented in
+                # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/credentials.html
+                bsess._session._credentials = cred
+                with timer('IoT client'):
+                    iotc = bsess.client('iot')
+                describe_thing = lambda d: iotc.describe_thing(thingName=d)
+            else:
+                describe_thing = lambda d: aws.describe_thing(cred, d, mysa_stuff.REGION, u._http)
 
-    if args.device:
-        if (missing := set(args.device) - set(devices)):
-            p.error(f"Device ID(s) {', '.join(missing)} not found in your Mysa account.")
-
-    if args.dump_lots:
-        print("GET /users | .json() | .User")
-        print("============================")
-        pprint(user)
-        print("GET /devices | .json() | .DevicesObj")
-        print("====================================")
-        pprint(devices)
-        print("GET /devices/state | .json() | .DeviceStatesObj")
-        print("===============================================")
-        pprint(states)
-        print("GET /devices/firmware | .json() | .Firmware")
-        print("===========================================")
-        pprint(firmware)
-        print("GET /homes | .json() | .Homes")
-        print("=============================")
-        pprint(homes)
-
-    print_device_states(devices, states, firmware, args.device)
-    if args.no_watch:
-        return
+            def get_serial(d):
+                with timer(f'IoT describe_thing {d}'):
+                    try:
+                        return describe_thing(d)['attributes']['Serial']
+                    except (botocore.exceptions.ClientError, aws.AwsError, KeyError):
+                        logger.warn(f'Could not get serial number for device ID {d}')
+                        return None
+
+            for d, ser in zip(misses, pool.map(get_serial, misses)):
+                devices[d]._serial = ser
+                if cache is not None and ser is not None:
+                    cache.put(username, d, Serial=ser)
+
+    return slurpy(u=u, sess=sess, cred=cred, user=user, homes=homes, devices=devices, states=states, firmware=firmware, timer=timer)
+
+
+async def bootstrap_all(usernames: list[str], **kwargs) -> list[slurpy]:
+    '''Bootstrap several Mysa accounts concurrently, non-interactively, skipping those which fail'''
+    accounts = []
+    results = await asyncio.gather(*(asyncio.to_thread(bootstrap, un, False, StageTimer(), **kwargs) for un in usernames),
+                                   return_exceptions=True)
+    for un, res in zip(usernames, results):
+        if isinstance(res, Exception):
+            logger.error(f'Could not log in to Mysa account {un!r}: {res}')
+        else:
+            accounts.append(res)
+    return accounts
 
-    print("Connecting to MQTT endpoint to watch real-time messages...")
 
-    # Now we need to use these credentials to do a "SigV4 presigning" of the target URL that
-    # will be used for the HTTP->websockets connection: https://a3q27gia9qg3zy-ats.iot.us-east-1.amazonaws.com/mqtt
-    # Mysa is doing SigV4 in an odd (and potentially insecure) way, see comments in this function.
-    signed_mqtt_url = mysa_stuff.sigv4_sign_mqtt_url(cred)
+async def watch_all(args, accounts: list[slurpy], archive: Optional[ReadingsArchive] = None):
+    # kill -USR1 dumps packet handling stage timings
+    profiling.dump_on_signal()
 
-    mqtt_urlp = urlparse(mysa_stuff.MQTT_WS_URL)
+    # All accounts' devices share one local model of device state, which is seeded from the JSON API
+    dtwin = twin.DeviceTwin()
+    for acct in accounts:
+        dtwin.merge_states(acct.states)
+    server = args.serve_state and await twin.serve(dtwin, args.serve_state)
+    if metrics_server := args.metrics and await metrics.serve(args.metrics):
+        metrics.counter_collector(metrics.mqtt_events, mqtt.stats, 'event')
 
-    # Let us touch the horrid boto3/AWS interfaces no more.
+    # Each injected message is sent only once, by the account which owns its device (or else the first account)
+    injects = [[] for _ in accounts]
+    for ij in args.inject:
+        did = ij.split('=', 1)[0].split('/')[-2]
+        injects[next((n for n, acct in enumerate(accounts) if did in acct.devices), 0)].append(ij)
+
+    # One MQTT connection per account, all multiplexed in this event loop
+    try:
+        await asyncio.gather(*(watch(args, acct, inject, dtwin, archive) for acct, inject in zip(accounts, injects)))
+    finally:
+        if server:
+            server.close()
+        if metrics_server:
+            metrics_server.close()
 
 
-    with connect(
-        urlparse(signed_mqtt_url)._replace(scheme='wss').geturl(),
-        # We get 426 errors without the Sec-WebSocket-Protocol header:
-        subprotocols=('mqtt',),
-        # Seemingly not necessary for the server, but Mysa official client adds all this:
-        origin=mqtt_urlp._replace(path='').geturl(),
-        additional_headers={'accept-encoding': 'gzip'},
-        user_agent_header=sess.headers['user-agent'],
-    ) as ws:
-        ws.send(mqttpacket.connect(str(uuid1()), 60))
-        assert isinstance(mqttpacket.parse_one(ws.recv()), mqttpacket.ConnackPacket)
-
-        for ii, did in enumerate((args.device or devices), 1):
-            # AWS IoT core seems to barf if we subscribe to too many topics at once
-            # (where "too many" is something like 10!!), so instead we iterate over them
-            ws.send(mqttpacket.subscribe(ii, [
-                mqttpacket.SubscriptionSpec(f'/v1/dev/{did}/out', 0x01),
-                mqttpacket.SubscriptionSpec(f'/v1/dev/{did}/in', 0x01),
-                mqttpacket.SubscriptionSpec(f'/v1/dev/{did}/batch', 0x01)
-                ]))
-            timeout = time() + 60
-            pkt = mqttpacket.parse_one(ws.recv())
-            assert isinstance(pkt, mqttpacket.SubackPacket) and pkt.packet_id == ii
-
-        print("Connected to MQTT endpoint and subscribed to device in/out/batch topics...")
+async def watch(args, acct: slurpy, inject: list[str], dtwin: 'twin.DeviceTwin', archive: Optional[ReadingsArchive] = None):
+    sess, user, devices, states, firmware = acct.sess, acct.user, acct.devices, acct.states, acct.firmware
+    pool = mqtt.MqttPool(acct.sign_mqtt_url, str(uuid1()), acct.specific or devices, args.shards, args.shard_by,
+                         sess.headers['user-agent'], topics_per_packet=args.subscribe_chunk, window=args.subscribe_window)
+    async with pool:
+        print(f"Connected to MQTT endpoint{f' with {len(pool.shards)} connections' if len(pool.shards) > 1 else ''} and subscribed to device in/out/batch topics...")
 
         if args.inject_dump_bin:
             now = int(time())
-            args.inject.extend([f'/v1/dev/{did}/in={{"Device":"{did}","Timestamp":{now},"MsgType":7}}'
-                               for did in (args.device or devices)])
+            inject = inject + [f'/v1/dev/{did}/in={{"Device":"{did}","Timestamp":{now},"MsgType":7}}'
+                               for did in (acct.specific or devices)]
 
-        for ii, ij in enumerate(args.inject):
+        for ii, ij in enumerate(inject):
             topic, j = ij.split('=', 1)
-            ws.send(mqttpacket.publish(topic, False, 1, False, packet_id=ii ^ 0x9000, payload=j.encode()))
+            pool.send(mqttpacket.publish(topic, False, 1, False, packet_id=ii ^ 0x9000, payload=j.encode()), topic.split('/')[-2])
             print(f'Injected MQTT message to {topic!r}, with QOS=1 and contents {j!r}')
 
-        timeout = time() + 60
-        recheck_device_state_at = {}
-        while True:
-            now = time()
-            for did, ts in list(recheck_device_state_at.items()):
-                if now > ts:
-                    print('Requerying device state from JSON API...')
-                    try:
-                        states[did] = (r := sess.get(f'{BASE_URL}/devices/state/{did}')).json(object_hook=slurpy).DeviceState
-                    except Exception:
-                        assert not r.ok
-                        logger.error(f"Request for device state failed: {r.status_code} {r.reason}")
-                    else:
-                        print_device_states(devices, states, firmware, (did,))
-                    del recheck_device_state_at[did]
+        # REST requeries of device state run alongside MQTT message handling
+        def rechecked(dids):
+            dtwin.merge_states({did: states[did] for did in dids})
+            print_device_states(devices, dtwin.snapshot(dids), firmware, dids)
 
-            try:
-                msg = mqttpacket.parse_one(ws.recv(timeout - time()))
-                logger.debug(f'Received packet: {msg}')
-            except TimeoutError:
-                pkt = None
-                ws.send(mqttpacket.pingreq())
-                logger.debug(f"Sent PINGREQ keepalive packet")
-                timeout = now + 60
+        rechecks = recheck.RecheckScheduler(sess, states, rechecked)
+        rechecker = asyncio.create_task(rechecks.run())
+        try:
+            await receive(pool, user, devices, firmware, dtwin, rechecks, archive)
+        finally:
+            rechecker.cancel()
+            print(f'Device state rechecks: {rechecks.report()}')
+
+
+async def receive(pool: 'mqtt.MqttPool', user: slurpy, devices: slurpy, firmware: slurpy, dtwin: 'twin.DeviceTwin',
+                  rechecks: 'recheck.RecheckScheduler', archive: Optional[ReadingsArchive] = None):
+    async for conn, msg in pool:
+        now = time()
+        if isinstance(msg, mqttpacket._packet.PubackPacket):
+            pass
+        elif isinstance(msg, mqttpacket.PublishPacket):
+            did, subtopic = msg.topic.split('/')[-2:]
+            if subtopic == 'in':
+                arrow = 'TO   ==>'
+            elif subtopic == 'out':
+                arrow = 'FROM <=='
+            elif subtopic == 'batch':
+                arrow = 'FROM <=='    # these are always FROM the device, right?
             else:
-                if isinstance(msg, (mqttpacket._packet.PingrespPacket,
-                                    mqttpacket._packet.PubackPacket)):
-                    pass
-                elif isinstance(msg, mqttpacket.PublishPacket):
-                    did, subtopic = msg.topic.split('/')[-2:]
-                    if subtopic == 'in':
-                        arrow = 'TO   ==>'
-                    elif subtopic == 'out':
-                        arrow = 'FROM <=='
-                    elif subtopic == 'batch':
-                        arrow = 'FROM <=='    # these are always FROM the device, right?
-                    else:
-                        arrow = f'?{subtopic}?'
-                    mac = ':'.join(did[n:n+2].upper() for n in range(0, len(did), 2))
-                    deets = ''.join(filter(None, [
-                        msg.qos and f' QOS={msg.qos}',
-                        msg.retain and ' +retain',
-                        msg.dup and ' +dup',
-                    ]))
+                arrow = f'?{subtopic}?'
+            mac = ':'.join(did[n:n+2].upper() for n in range(0, len(did), 2))
+            deets = ''.join(filter(None, [
+                msg.qos and f' QOS={msg.qos}',
+                msg.retain and ' +retain',
+                msg.dup and ' +dup',
+            ]))
 
-                    understood = ts = orig_json = None
-
-                    try:
-                        j = json.loads(msg.payload, object_hook=slurpy, strict=False)
-                        orig_json = deepcopy(j)
-                        if (mt := j.pop('MsgType', None)) is not None:
-                            if 'device' in j and 'timestamp' in j:
-                                # newer firmware (?) sends lowercase version for some messages
-                                assert j.pop('device') == did
-                                ts = j.pop('timestamp')
-                            else:
-                                assert j.pop('Device') == did
-                                ts = j.pop('Timestamp')
-                            if mt == 11 and subtopic == 'in':
-                                understood = f'App telling device to publish its status ({json.dumps(j)})'
-                            elif mt == 6 and subtopic == 'in':
-                                understood = f'App telling device to check its settings ({json.dumps(j)})'
-                                recheck_device_state_at[did] = ts
-                            elif mt == 7 and subtopic == 'in':
-                                understood = f'App telling device to dump its readings ({json.dumps(j)})'
-                            elif mt == 40 and subtopic == 'in':
-                                eid = j.pop('EchoID')
-                                understood = f'Killer ping command with EchoID={eid} ({json.dumps(j)})'
-                            elif mt == 5 and subtopic == 'out':
-                                eid = j.pop('EchoID')
-                                understood = f'Killer ping response ({json.dumps(j)})'
-                            elif mt == 4 and subtopic == 'out':
-                                level, message = j.pop('Level'), j.pop('Message')
-                                understood = f'Device log [{level}] {message} ({json.dumps(j)})'
-                            elif mt == 0 and subtopic == 'out':
-                                assert j.pop('Stream') == 1
-                                understood = f'Device (V1?) reporting its status: {json.dumps(j)}'
-                            elif mt == 1 and subtopic == 'out':
-                                understood = f'Unclear prev/next message from device: {json.dumps(j)}'
-                            elif mt == 10 and subtopic == 'out':
-                                understood = f'Post-boot message: {json.dumps(j)}'
-                            elif mt == 20 and subtopic == 'in':
-                                understood = f'Unknown MsgType=20, might be "check your status" similar to MsgType=6 ({json.dumps(j)})'
-                                recheck_device_state_at[did] = ts
-                        elif (mt := j.pop('msg')) is not None:
-                            if mt in (40, 17, 16) and subtopic == 'out':
-                                assert j.pop('ver') == '1.0'
-                                assert j.pop('src') == {'ref': did, 'type': 1}
-                                ts = j.pop('time')
-                                body = j.pop('body')
-                                if mt == 40:
-                                    guess = 'V2?'
-                                elif mt == 17:
-                                    guess = 'V1-INF?'
-                                elif mt == 16:
-                                    guess = 'weird msg=16 from V1-INF?'
-                                understood = f'Device ({guess}) reporting its status: {json.dumps(body)}'
-                            elif mt == 44 and subtopic == 'in':
-                                ts = j.pop('id') / 1000
-                                assert j.pop('ver') == '1.0'
-                                assert j.pop('dest') == {'ref': did, 'type': 1}
-                                assert j.pop('resp') == 2
-                                assert abs(j.pop('Timestamp') - int(ts)) <= 1   # Sometimes randomly off by 1 sec
-                                assert j.pop('time') == int(ts)
-                                # This 'timestamp'/'Timestamp' thing was due to my mistake in liten-up
-                                assert 'timestamp' not in j
-                                src = j.pop('src')
-                                if src == {'ref': user.Id, 'type': 100}:
-                                    by = 'You'
-                                elif src.type == 100:
-                                    by = f'Other user {src.ref}'
-                                else:
-                                    by = json.dumps(src)
-                                assert set(j.keys()) == {'body'}
-                                body = j.body
-                                assert body.pop('ver')
-                                if isinstance(body['cmd'], str):
-                                    body['cmd'] = json.loads(body['cmd'])
-                                    weird = ' (derpy stringified cmd)'
-                                else:
-                                    weird = ''
-                                understood = f'{by} commanding device{weird}: {json.dumps(body)}'
-                            elif mt == 44 and subtopic == 'out':
-                                ts = j.pop('time')
-                                assert j.pop('ver') == '1.0'
-                                assert j.pop('src') == {'ref': did, 'type': 1}
-                                assert abs(ts - j.pop('resp_id') / 1000) <= 5  # <=5 sec delay
-                                id_ = j.pop('id')
-                                body = j.pop('body')
-                                assert not j
-                                assert body.pop('success') == 1
-                                if body.get('trig_src') == 3:
-                                    cmd_src = 'app command'
-                                elif body.get('trig_src') == 1:
-                                    cmd_src = 'buttons'
-                                else:
-                                    cmd_src = 'command of unknown trig_src'
-                                understood = f'Device responding to {cmd_src}: {json.dumps(body)} (id={id_})'
-                            elif mt == 34 and subtopic == 'in':
-                                ts = j.pop('time')
-                                assert j.pop('ver') == '1.0'
-                                assert j.pop('dest') == {'ref': did, 'type': 1}
-                                id_ = j.pop('id')
-                                src = j.pop('src')
-                                assert src.pop('type') == 302
-                                src_ref = src.pop('ref')
-                                assert not src
-                                body = j.pop('body')
-                                assert not j
-                                assert body.pop('ver') == '3.0.0'
-                                hash = body.pop('hash')
-                                events = body.pop('events')
-                                nevents = body.pop('totalEvents')
-                                if events:
-                                    assert len(events) <= nevents
-                                    ctime = body.pop('createTime')
-                                    assert hash
-                                    assert src_ref
-                                    understood = f'Set schedule (source {src_ref}, createTime {ctime}, hash {hash}), {len(events)}/{nevents} events: {events}'
-                                else:
-                                    assert nevents == 0
-                                    # assert not hash    # usually empty, but not always
-                                    assert not src_ref
-                                    understood = f'Delete schedule (hash {hash!r})'
-                                assert not body
-                            elif mt == 61 and subtopic == 'out':
-                                assert j.pop('time') == 0
-                                assert j.pop('ver') == '1.0'
-                                assert j.pop('src') == {'ref': did, 'type': 1}
-                                id_ = j.pop('id')
-                                body = j.pop('body')
-                                assert not j
-                                fw = body.pop('fw')
-                                assert not body
-                                understood = f'Device boot-up message with firmware version {fw}'
-                            elif mt == 3 and subtopic == 'batch':
-                                ts = j.pop('time')
-                                assert j.pop('ver') == '1.0'
-                                assert j.pop('src') == {'ref': did, 'type': 1}
-                                id_ = j.pop('id')
-                                body = j.pop('body')
-                                assert not(j)
-                                raw = base64.b64decode(body.pop('readings'))
-                                assert not body
-                                readings = MysaReading.parse_readings(raw)
-                                recheck_device_state_at[did] = ts + 60
-                                understood = f'Raw readings (v{readings[0].ver}):\n' + ''.join(f'  {r}\n' for r in readings)
-                    except Exception as exc:
-                        print(f"Exception while parsing message payload: {traceback.format_exc()}")
-                        ts = time()
-
-                    if understood and ts:
-                        understood = f'[{now - ts:.1f}s ago] ' + understood
-
-                    if did in devices:
-                        print(f'{arrow} {devices[did].Name}{deets} (model {devices[did].Model!r}, mac {mac}, firmware {firmware[did].InstalledVersion}):')
-                    else:
-                        print(f'{arrow} Unknown device {did} (topic {msg.topic})')
+            understood = ts = m = payload = None
 
-                    if understood:
-                        print(f'  {understood}')
-                    elif orig_json:
-                        print(f'  {json.dumps(orig_json)}')
-                    else:
-                        print(f'  {msg.payload}')
+            sw = profiling.Stopwatch()
+            try:
+                payload = messages.loads(msg.payload)
+                sw.lap('json')
+                m = messages.decode(did, subtopic, payload)
+                sw.lap('classify')
+                if isinstance(m, messages.Readings):
+                    m.readings  # parse them now (rather than lazily in describe), to time it separately
+                    sw.lap('readings')
+                ts, understood = m.ts, m.describe(user.Id)
+                sw.lap('format')
+                dtwin.update(m, now)
+                metrics.observe_message(m, now)
+                if (recheck_at := m.recheck_at) is not None:
+                    rechecks.request(did, recheck_at)
+                if archive and isinstance(m, messages.Readings):
+                    n = archive.append(did, m.raw)
+                    understood += f'  ({n} new readings archived)'
+                sw.lap('update')
+            except Exception as exc:
+                metrics.decode_failures.inc(stage='json' if payload is None else 'decode' if m is None else 'handle')
+                print(f"Exception while parsing message payload: {traceback.format_exc()}")
+                ts = time()
+
+            if understood and ts:
+                understood = f'[{now - ts:.1f}s ago] ' + understood
+
+            if did in devices:
+                print(f'{arrow} {devices[did].Name}{deets} (model {devices[did].Model!r}, mac {mac}, firmware {firmware[did].InstalledVersion}):')
+            else:
+                print(f'{arrow} Unknown device {did} (topic {msg.topic})')
 
-                    if msg.qos > 0:
-                        ws.send(mqttpacket.puback(msg.packetid))
-                        timeout = time() + 60
-                else:
-                    pprint(msg)
+            if understood:
+                print(f'  {understood}')
+            else:
+                # Not understood, so show the original payload exactly as received
+                print(f'  {msg.payload.decode(errors="backslashreplace")}')
+            sw.lap('print')
+
+            if msg.qos > 0:
+                conn.send(mqttpacket.puback(msg.packetid))
+            sw.lap('send')
+            sw.done('(not decoded)' if m is None else type(m).__name__)
+        else:
+            pprint(msg)
 
 
 def print_device_states(devices: slurpy, states: slurpy, firmware: slurpy, specific=None):
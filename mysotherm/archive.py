@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+'''
+Append-only, on-disk archive of raw readings from Mysa thermostats.
+
+Layout:
+
+    $ROOT/$DID/$FIRST_TS-v$VER.bin   Raw on-the-wire readings (MysaReading.__bytes__), concatenated
+    $ROOT/$DID/$FIRST_TS-v$VER.idx   Timestamp of each reading in the .bin file (native uint32 array)
+
+All readings in a segment have the same version (and thus the same size), and are
+in strictly increasing timestamp order, so the N-th timestamp in the .idx file
+corresponds to offset N*size in the .bin file. The .idx files are memory-mapped
+and bisected for time-range queries, so only the matching readings are read.
+
+Readings which are out of order (e.g. backfilled batches) go into new segments, and
+readings whose timestamps are already present in the archive are ignored.
+
+A crash during an append can leave a segment whose .idx is missing or shorter than
+its .bin (which is always written first). Queries only use the readings that are
+in both, and the first append to a device rebuilds the rest of the .idx from the .bin.
+
+A ReadingsArchive keeps the (repaired) indexes of the devices it has appended to in
+memory, so only one process at a time should append to an archive.
+'''
+from argparse import ArgumentParser
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from heapq import merge
+import logging
+import mmap
+import os
+import re
+import struct
+from typing import Iterator, Optional
+
+from .mysa_stuff import MysaReading, _known_reading_vers
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = '~/.local/share/mysotherm/readings'
+
+_segment_re = re.compile(r'^(\d+)-v(\d+)\.bin$')
+
+
+class _Segment:
+    __slots__ = ('path', 'first_ts', 'ver', 'size', 'count', 'tss')
+
+    def __init__(self, path: str, first_ts: int, ver: int):
+        self.path = path          # Without .bin/.idx suffix
+        self.first_ts = first_ts
+        self.ver = ver
+        self.size = _known_reading_vers[ver]._size
+        self.count = 0            # Number of readings present in both the .bin and the .idx
+        self.tss = None           # In-memory copy of the .idx, once loaded for appending
+
+    def __len__(self):
+        return self.count
+
+    def _sizes(self) -> tuple[int, int]:
+        '''Sizes of the .bin and .idx in bytes (-1 if the .idx is missing)'''
+        try:
+            isize = os.path.getsize(self.path + '.idx')
+        except FileNotFoundError:
+            isize = -1
+        return os.path.getsize(self.path + '.bin'), isize
+
+    def check(self) -> int:
+        bsize, isize = self._sizes()
+        self.count = max(0, min(bsize // self.size, isize // 4))
+        return self.count
+
+    def repair(self) -> int:
+        '''Make the .bin and .idx consistent again after a torn write: drop any partial
+        reading at the end of the .bin, and rebuild any missing timestamps in the .idx'''
+        bsize, isize = self._sizes()
+        nbin, nidx = bsize // self.size, max(0, min(bsize // self.size, isize // 4))
+        if bsize != nbin * self.size:
+            logger.warning(f'Truncating partial reading at end of {self.path}.bin')
+            os.truncate(self.path + '.bin', nbin * self.size)
+        if isize != nidx * 4:
+            with open(self.path + '.idx', 'ab') as f:   # creates it if missing
+                f.truncate(nidx * 4)
+        if nidx < nbin:
+            logger.warning(f'Rebuilding {nbin - nidx} missing timestamps in {self.path}.idx')
+            data = self.read(nidx, nbin)
+            # Each reading is 0xcaa0, the version byte, and then its little-endian uint32 timestamp
+            tss = array('I', (struct.unpack_from('<L', data, off + 3)[0] for off in range(0, len(data), self.size)))
+            with open(self.path + '.idx', 'ab') as f:
+                tss.tofile(f)
+        self.count = nbin
+        return self.count
+
+    def load(self) -> int:
+        '''Repair the segment, and read its whole index into memory (for appending)'''
+        self.repair()
+        self.tss = array('I')
+        with open(self.path + '.idx', 'rb') as f:
+            self.tss.fromfile(f, self.count)
+        return self.count
+
+    def extend(self, readings: list[MysaReading]):
+        '''Append readings, which must all be of this segment's version, in strictly increasing
+        timestamp order, and newer than any already in the segment'''
+        tss = array('I', (r.ts for r in readings))
+        # Write the readings before their timestamps, so that the index never points past the end of the data
+        with open(self.path + '.bin', 'ab') as f:
+            f.writelines(bytes(r) for r in readings)
+        with open(self.path + '.idx', 'ab') as f:
+            tss.tofile(f)
+        self.tss.extend(tss)
+        self.count += len(tss)
+
+    def timestamps(self):
+        '''Context manager yielding a memory-mapped, bisectable sequence of timestamps'''
+        return _MappedIndex(self.path + '.idx', self.count)
+
+    def read(self, start: int, stop: int) -> bytes:
+        with open(self.path + '.bin', 'rb') as f:
+            f.seek(start * self.size)
+            return f.read((stop - start) * self.size)
+
+
+class _MappedIndex:
+    def __init__(self, path: str, count: int):
+        self.path = path
+        self.count = count
+
+    def __enter__(self) -> memoryview:
+        if not self.count:
+            # Can't mmap an empty file
+            self.f = self.mm = self.raw = None
+            self.mv = memoryview(b'').cast('I')
+            return self.mv
+        self.f = open(self.path, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.raw = memoryview(self.mm)
+        self.mv = self.raw[:self.count * 4].cast('I')
+        return self.mv
+
+    def __exit__(self, *exc):
+        self.mv.release()
+        if self.mm is not None:
+            self.raw.release()
+            self.mm.close()
+            self.f.close()
+
+
+class ReadingsArchive:
+    def __init__(self, root: str = ARCHIVE_DIR, max_segment_readings: int = 1 << 20):
+        self.root = os.path.expanduser(root)
+        self.max_segment_readings = max_segment_readings
+        self._loaded: dict[str, list[_Segment]] = {}   # did -> segments, with their indexes loaded for append()
+
+    def devices(self) -> list[str]:
+        try:
+            return sorted(d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d)))
+        except FileNotFoundError:
+            return []
+
+    def _segments(self, did: str, load: bool = False) -> list[_Segment]:
+        '''Segments of a device's readings which contain any readings.
+
+        With load=False (for reading), a segment's readings are only those which are in both its
+        .bin and its .idx. With load=True (for appending), any torn writes are repaired, and the
+        indexes are read into memory.'''
+        ddir = os.path.join(self.root, did)
+        try:
+            names = os.listdir(ddir)
+        except FileNotFoundError:
+            return []
+        segs = [_Segment(os.path.join(ddir, n[:-4]), int(m.group(1)), int(m.group(2)))
+                for n in names if (m := _segment_re.match(n))]
+        return sorted((s for s in segs if (s.load() if load else s.check())), key=lambda s: s.first_ts)
+
+    @staticmethod
+    def _contains(segs: list[_Segment], ts: int) -> bool:
+        for s in segs:
+            if s.first_ts <= ts <= s.tss[-1]:
+                if (ii := bisect_left(s.tss, ts)) < len(s.tss) and s.tss[ii] == ts:
+                    return True
+        return False
+
+    def _write(self, did: str, segs: list[_Segment], tail: Optional[_Segment], readings: list[MysaReading]):
+        '''Write readings (in strictly increasing timestamp order) to the end of tail if possible,
+        and otherwise to new segments'''
+        run = []
+        for r in readings:
+            if tail is None or tail.ver != r.ver or len(tail) + len(run) >= self.max_segment_readings:
+                if run:
+                    tail.extend(run)
+                    run = []
+                os.makedirs(os.path.join(self.root, did), exist_ok=True)
+                tail = _Segment(os.path.join(self.root, did, f'{r.ts:010d}-v{r.ver}'), r.ts, r.ver)
+                tail.tss = array('I')
+                segs.append(tail)
+            run.append(r)
+        if run:
+            tail.extend(run)
+
+    def append(self, did: str, readings: bytes) -> int:
+        '''Append raw readings (as sent to /v1/dev/$DID/batch) for a device.
+
+        Returns the number of readings actually added.'''
+        if (segs := self._loaded.get(did)) is None:
+            segs = self._loaded[did] = self._segments(did, load=True)
+        tail = max(segs, key=lambda s: s.tss[-1], default=None)
+        newest = tail.tss[-1] if tail else -1
+
+        # New readings continue the newest segment, and any older ones not already in the archive
+        # (backfill) are collected and sorted into new segments, rather than scattered over many
+        new, new_tss, backfill = [], array('I'), {}
+        for r in MysaReading.iter_readings(readings):
+            if r.ver not in _known_reading_vers:
+                raise ValueError(f'Cannot archive readings of unknown version {r.ver}')
+            if r.ts > newest:
+                new.append(r)
+                new_tss.append(newest := r.ts)
+            elif r.ts not in backfill and not self._contains(segs, r.ts) and not (
+                    (ii := bisect_left(new_tss, r.ts)) < len(new_tss) and new_tss[ii] == r.ts):
+                backfill[r.ts] = r
+
+        self._write(did, segs, None, sorted(backfill.values(), key=lambda r: r.ts))
+        self._write(did, segs, tail, new)
+        return len(backfill) + len(new)
+
+    def iter_query(self, did: str, since: Optional[int] = None, until: Optional[int] = None) -> Iterator[MysaReading]:
+        '''Readings for a device with since <= ts < until, in chronological order.'''
+        runs = []
+        for s in self._segments(did):
+            if until is not None and s.first_ts >= until:
+                continue
+            with s.timestamps() as tsi:
+                start = 0 if since is None else bisect_left(tsi, since)
+                stop = len(tsi) if until is None else bisect_left(tsi, until)
+            if start < stop:
+                runs.append(MysaReading.iter_readings(s.read(start, stop)))
+        return merge(*runs, key=lambda r: r.ts)
+
+    def query(self, did: str, since: Optional[int] = None, until: Optional[int] = None) -> list[MysaReading]:
+        return list(self.iter_query(did, since, until))
+
+
+def _timestamp(s: str) -> int:
+    try:
+        return int(s)
+    except ValueError:
+        return int(datetime.fromisoformat(s).timestamp())
+
+
+def main(args=None):
+    p = ArgumentParser(description='Query the archive of raw readings saved by mysotherm --archive')
+    p.add_argument('-A', '--archive', default=ARCHIVE_DIR, help='Archive directory (default %(default)r)')
+    p.add_argument('-d', '--device', action='append',
+                   type=lambda s: s.replace(':','').lower(), help='Specific device (MAC address); may be repeated')
+    p.add_argument('-s', '--since', type=_timestamp, help='Start of time window (Unix time or ISO 8601)')
+    p.add_argument('-t', '--until', type=_timestamp, help='End of time window (Unix time or ISO 8601)')
+    args = p.parse_args(args)
+
+    arc = ReadingsArchive(args.archive)
+    for did in (args.device or arc.devices()):
+        print(f'Device {did}:')
+        for r in arc.iter_query(did, args.since, args.until):
+            print(f'  {r}')
+
+
+if __name__ == '__main__':
+    main()
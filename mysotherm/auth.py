@@ -3,6 +3,8 @@ import configparser
 import getpass
 import logging
 import os
+import threading
+from datetime import datetime
 from time import time
 from typing import Optional
 
@@ -17,6 +19,20 @@ logger = logging.getLogger(__name__)
 
 CONFIG_FILE = '~/.config/mysotherm'
 
+# Serializes read-modify-write of the config file, when multiple accounts' tokens are refreshed concurrently
+_config_lock = threading.Lock()
+
+
+def configured_users(cf: str = CONFIG_FILE) -> list[str]:
+    config = configparser.ConfigParser()
+    cf = os.path.expanduser(cf)
+    try:
+        config.read(cf)
+    except configparser.Error as exc:
+        raise NotImplementedError(f"Could not read config file {cf!r}") from exc
+    return [s[5:] for s in config.sections() if s.startswith('mysa:')]
+
+
 def authenticate(
     user: Optional[str] = None,
     cf: str = CONFIG_FILE,
@@ -85,6 +101,21 @@ def load_credentials(
     # Monkey-stuff password into it
     setattr(u, '_password', password)
 
+    # Reuse the Cognito identity ID and unexpired temporary AWS credentials, if we have them
+    u.identity_id = config.get(section, 'identity_id', fallback=None)
+    if (akid := config.get(section, 'aws_access_key_id', fallback=None)) is not None:
+        try:
+            u.aws_credentials = {
+                'AccessKeyId': akid,
+                'SecretKey': config.get(section, 'aws_secret_key'),
+                'SessionToken': config.get(section, 'aws_session_token'),
+                'Expiration': datetime.fromisoformat(config.get(section, 'aws_expiration')),
+            }
+        except (configparser.Error, ValueError):
+            logger.warning(f'Ignoring incomplete cached AWS credentials in section {section!r} of config file {cf!r}')
+    if writeback:
+        u.on_credentials = lambda: write_credentials(cf, u)
+
     try:
         u.verify_token(u.id_token, "id_token", "id")
     except (pycognito.TokenVerificationException, jwt.exceptions.PyJWTError):
@@ -123,10 +154,16 @@ def login(user: str, password: str, bsess: Optional[boto3.session.Session] = Non
     logger.debug(f'Successfully authenticated as user {user!r}')
     if cf:
         write_credentials(cf, u)
+        u.on_credentials = lambda: write_credentials(cf, u)
     return u
 
 
 def write_credentials(cf: str, u: Cognito):
+    with _config_lock:
+        _write_credentials(cf, u)
+
+
+def _write_credentials(cf: str, u: Cognito):
     config = configparser.ConfigParser()
     cf = os.path.expanduser(cf)
     user = u.id_claims["cognito:username"]
@@ -135,7 +172,9 @@ def write_credentials(cf: str, u: Cognito):
     except configparser.Error as exc:
         logger.warning('Discarding unparseable contents of {cf!r}: {exc}')
 
-    with open(cf, 'w') as cf:
+    # This file contains secrets, so make sure only the user can read it
+    with open(os.open(cf, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        os.fchmod(f.fileno(), 0o600)
         section = f'mysa:{user}'
         if not config.has_section(section):
             config.add_section(section)
@@ -144,5 +183,12 @@ def write_credentials(cf: str, u: Cognito):
         if getattr(u, '_password', None) is not None:
             password_b64 = binascii.b2a_base64(u._password.encode(), newline=False).decode()
             config.set(section, 'password_b64', password_b64)
-        config.write(cf)
-    logger.info(f'Successfully wrote credentials for user {user!r} to {cf.name!r}')
+        if u.identity_id is not None:
+            config.set(section, 'identity_id', u.identity_id)
+        if (c := u.aws_credentials) is not None:
+            config.set(section, 'aws_access_key_id', c['AccessKeyId'])
+            config.set(section, 'aws_secret_key', c['SecretKey'])
+            config.set(section, 'aws_session_token', c['SessionToken'])
+            config.set(section, 'aws_expiration', c['Expiration'].isoformat())
+        config.write(f)
+    logger.info(f'Successfully wrote credentials for user {user!r} to {cf!r}')
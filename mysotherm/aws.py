@@ -1,6 +1,9 @@
+import json
 import os
+from datetime import datetime, timedelta, timezone
 from functools import wraps
-from typing import Optional
+from typing import Callable, Optional
+from urllib.parse import quote
 
 # boto3 is stupid AF and by default it wastes 1 second trying to connect to EC2 metadata
 # every single time you run it, unless you set these environment variables
@@ -15,6 +18,10 @@ os.environ['AWS_EC2_METADATA_DISABLED'] = 'true'        # <-- only works if boto
 import boto3, botocore
 
 import pycognito
+import requests
+
+from . import sigv4
+from .sigv4 import AwsError
 
 class Cognito(pycognito.Cognito):
     """
@@ -29,13 +36,32 @@ class Cognito(pycognito.Cognito):
         *args, **kwargs
     ):
         self._session = session
+        self._http = requests.Session()
         super().__init__(*args, session=session, **kwargs)
         self.pool_jwk = pool_jwk
 
+    use_boto3_clients: bool = bool(os.environ.get('MYSOTHERM_BOTO3_CLIENTS'))
+    """Use boto3 client objects for the AWS API calls, rather than our own lightweight SigV4/JSON implementation
+    (creating each boto3 client object means loading and parsing a large JSON service model, which is slow)"""
+
+    identity_id: Optional[str] = None
+    """Cognito identity ID (stable for a given user and identity pool)"""
+
+    aws_credentials: Optional[dict] = None
+    """Most recent temporary AWS credentials from cognito-identity (AccessKeyId, SecretKey, SessionToken, Expiration)"""
+
+    on_credentials: Optional[Callable[[], None]] = None
+    """Called after the identity ID or AWS credentials change, e.g. to persist them"""
+
+    AWS_CREDENTIALS_MIN_LIFETIME = timedelta(minutes=20)
+    """Reuse cached AWS credentials only if they're valid for at least this long (botocore wants to refresh them
+    if they have less than 15 minutes left)"""
+
     def get_credentials(self,
         identity_pool_id: str = None,
         identity_id: str = None,
         region: Optional[str] = None,
+        force: bool = False,
     ) -> botocore.credentials.Credentials:
         if not identity_pool_id and not identity_id:
             raise ValueError("Either identity_pool_id or identity_id must be specified")
@@ -43,28 +69,18 @@ class Cognito(pycognito.Cognito):
         if region is None:
             region = self.user_pool_region
 
-        if self._session:
-            client = self._session.client('cognito-identity', region_name=region)
-        else:
-            client = boto3.client('cognito-identity', region_name=region)
-
-        # https://boto3.amazonaws.com/v1/documentation/api/1.26.93/reference/services/cognito-identity/client/get_id.html
-        # "cognito-idp.<region>.amazonaws.com/<YOUR_USER_POOL_ID>"
-        assert self.id_claims['iss'].startswith('https://')
-        logins = {self.id_claims['iss'][8:]: self.id_token}
-
-        if not identity_id:
-            r = client.get_id(IdentityPoolId=identity_pool_id, Logins=logins)
-            identity_id = r['IdentityId']
-        r = client.get_credentials_for_identity(IdentityId=identity_id, Logins=logins)
-        c = r['Credentials']
-
         def _refresh_credentials():
             try:
                 self.verify_token(self.id_token, "id_token", "id")
             except pycognito.TokenVerificationException:
                 self.renew_access_token()  # despite the name, this also renews the id_token
-            return self.get_credentials(identity_id=identity_id, region=region)
+            c = self._fetch_credentials(identity_pool_id, identity_id, region)
+            return dict(access_key=c['AccessKeyId'], secret_key=c['SecretKey'], token=c['SessionToken'],
+                        expiry_time=c['Expiration'].isoformat())
+
+        c = self.aws_credentials
+        if force or not c or c['Expiration'] - datetime.now(timezone.utc) < self.AWS_CREDENTIALS_MIN_LIFETIME:
+            c = self._fetch_credentials(identity_pool_id, identity_id, region)
 
         return botocore.credentials.RefreshableCredentials(
             c['AccessKeyId'],
@@ -73,3 +89,78 @@ class Cognito(pycognito.Cognito):
             c['Expiration'],
             method='cognito-idp',
             refresh_using=_refresh_credentials)
+
+    def _fetch_credentials(self, identity_pool_id: Optional[str], identity_id: Optional[str], region: str) -> dict:
+        if self.use_boto3_clients:
+            if self._session:
+                client = self._session.client('cognito-identity', region_name=region)
+            else:
+                client = boto3.client('cognito-identity', region_name=region)
+        else:
+            client = _CognitoIdentityClient(self._http, region)
+
+        # https://boto3.amazonaws.com/v1/documentation/api/1.26.93/reference/services/cognito-identity/client/get_id.html
+        # "cognito-idp.<region>.amazonaws.com/<YOUR_USER_POOL_ID>"
+        assert self.id_claims['iss'].startswith('https://')
+        logins = {self.id_claims['iss'][8:]: self.id_token}
+
+        if not identity_id:
+            identity_id = self.identity_id
+        if not identity_id:
+            r = client.get_id(IdentityPoolId=identity_pool_id, Logins=logins)
+            identity_id = r['IdentityId']
+        r = client.get_credentials_for_identity(IdentityId=identity_id, Logins=logins)
+        self.identity_id = identity_id
+        self.aws_credentials = c = {k: r['Credentials'][k] for k in ('AccessKeyId', 'SecretKey', 'SessionToken', 'Expiration')}
+        if self.on_credentials:
+            self.on_credentials()
+        return c
+
+
+class _CognitoIdentityClient:
+    """Just enough of the boto3 'cognito-identity' client for _fetch_credentials.
+
+    Both of the API calls that we need are unsigned (the Cognito id_token is what authenticates them),
+    so they're simply JSON POSTs."""
+    def __init__(self, http: requests.Session, region: str):
+        self.http = http
+        self.url = f'https://cognito-identity.{region}.amazonaws.com/'
+
+    def _call(self, op: str, **params) -> dict:
+        r = self.http.post(self.url, data=json.dumps(params), headers={
+            'content-type': 'application/x-amz-json-1.1',
+            'x-amz-target': f'AWSCognitoIdentityService.{op}'})
+        if not r.ok:
+            raise _aws_error(r)
+        return r.json()
+
+    def get_id(self, **params) -> dict:
+        return self._call('GetId', **params)
+
+    def get_credentials_for_identity(self, **params) -> dict:
+        r = self._call('GetCredentialsForIdentity', **params)
+        r['Credentials']['Expiration'] = datetime.fromtimestamp(r['Credentials']['Expiration'], timezone.utc)
+        return r
+
+
+def _aws_error(r: requests.Response) -> AwsError:
+    try:
+        body = r.json()
+    except ValueError:
+        body = {}
+    # Error code is in the x-amzn-ErrorType header (REST APIs) or the __type field (JSON APIs),
+    # possibly followed by ':...' or preceded by 'namespace#'
+    code = r.headers.get('x-amzn-errortype') or body.get('__type') or str(r.status_code)
+    code = code.split(':', 1)[0].rsplit('#', 1)[-1]
+    return AwsError(code, body.get('message') or body.get('Message') or r.reason, r.status_code)
+
+
+def describe_thing(cred: botocore.credentials.Credentials, thing_name: str, region: str,
+                   http: Optional[requests.Session] = None) -> dict:
+    """Equivalent to boto3.client('iot').describe_thing(thingName=thing_name), without the boto3 client"""
+    frozen = cred.get_frozen_credentials() if hasattr(cred, 'get_frozen_credentials') else cred
+    url = f'https://iot.{region}.amazonaws.com/things/{quote(thing_name, safe="")}'
+    r = (http or requests).get(url, headers=sigv4.sign_headers('GET', url, frozen, 'iot', region))
+    if not r.ok:
+        raise _aws_error(r)
+    return r.json()
@@ -0,0 +1,74 @@
+import json
+import logging
+import os
+import threading
+from time import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = '~/.cache/mysotherm/devices.json'
+
+
+class DeviceCache:
+    '''
+    On-disk cache of immutable device metadata (serial number), keyed by Mysa account
+    username and device ID.
+
+    Serial numbers come from a separate AWS IoT API call per device (see mysotherm.__main__.bootstrap),
+    and never change, so this saves a round trip per device on every run. (Other metadata, like
+    the model and time zone, comes with the device list from GET /devices, which we need anyway.)
+    '''
+    FIELDS = ('Serial',)
+
+    def __init__(self, path: str = CACHE_FILE, ttl: float = 30 * 86400):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            with open(self.path) as f:
+                self._data = json.load(f)
+        except FileNotFoundError:
+            self._data = {}
+        except (OSError, ValueError) as exc:
+            logger.warning(f'Discarding unreadable device cache {self.path!r}: {exc}')
+            self._data = {}
+
+    def get(self, user: str, did: str) -> Optional[dict]:
+        '''Cached metadata for a device, or None if missing or expired'''
+        with self._lock:
+            entry = self._data.get(user, {}).get(did)
+        if entry is None or time() > entry['t'] + self.ttl:
+            return None
+        return {k: entry[k] for k in self.FIELDS if k in entry}
+
+    def put(self, user: str, did: str, **fields):
+        unknown = set(fields) - set(self.FIELDS)
+        assert not unknown, f'Unknown device metadata field(s) {unknown}'
+        with self._lock:
+            self._data.setdefault(user, {})[did] = dict(fields, t=time())
+            self._dirty = True
+
+    def invalidate(self, user: Optional[str] = None, did: Optional[str] = None):
+        '''Forget cached metadata for one device, all devices of one account, or everything'''
+        with self._lock:
+            if user is None:
+                self._data.clear()
+            elif did is None:
+                self._data.pop(user, None)
+            else:
+                self._data.get(user, {}).pop(did, None)
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._data, f, indent=1)
+            os.replace(tmp, self.path)
+            self._dirty = False
+        logger.debug(f'Wrote device cache to {self.path!r}')
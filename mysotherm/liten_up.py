@@ -1,51 +1,119 @@
 #!/usr/bin/env
 from argparse import ArgumentParser
-from base64 import b64decode, b64encode
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from base64 import b64encode
 import json
 import logging
 import os
+import random
+import re
 from sys import stderr
-from time import time, sleep
+from time import monotonic, time, sleep
 from typing import Optional
 from uuid import uuid1
-from urllib.parse import urlparse
 
 logging.basicConfig(format='[%(levelname)s:%(name)s] %(asctime)s - %(message)s',
     level=os.environ.get('LOGLEVEL', 'INFO').strip().upper())
 logger = logging.getLogger(__name__)
 
-from .util import slurpy
-from . import mysa_stuff
+from .util import lazy_import, slurpy
+from . import mysa_stuff, messages
 from .aws import boto3
-from .mysa_stuff import BASE_URL, MysaReading, MysaReadingV0, MysaReadingV3
+from .mysa_stuff import BASE_URL, MysaReading, transcode_readings_v3_to_v0
 from .auth import authenticate, login, write_credentials, CONFIG_FILE
 
-import websockets.exceptions, websockets.sync.client
-import mqttpacket.v311 as mqttpacket
 import requests
+from requests.adapters import HTTPAdapter
+
+# Only needed for the MQTT proxy, so don't slow down --reset with them
+asyncio = lazy_import('asyncio')
+ws_exceptions = lazy_import('websockets.exceptions')
+mqttpacket = lazy_import('mqttpacket.v311')
+mqtt = lazy_import(f'{__package__}.mqtt')
+metrics = lazy_import(f'{__package__}.metrics')
+profiling = lazy_import(f'{__package__}.profiling')
 
 # Device firmware versions on which this is known to work
 FW_VMIN, FW_VMAX = (3, 13, 1, 25), (3, 17, 5, 13)
 
+# Only these (subtopic, "msg" type) combinations ever need translating
+_translated_msg_types = {'in': b'44', 'batch': b'3', 'out': b'40'}
+_msg_type_re = re.compile(rb'"msg"\s*:\s*(\d+)')
+
+SIGNED_URL_REUSE = 45 * 60
+"""Reuse a signed MQTT URL (which is valid for an hour) for reconnecting for at most this many seconds,
+and only while the AWS credentials in it remain valid for at least 5 more minutes"""
+
+stats = Counter()
+"""Counts of published messages which were passed through without parsing ('skipped'), which were
+parsed because they might need translating ('parsed'), and which were actually translated ('translated')"""
+
+
+def might_need_translation(subtopic: str, payload: bytes) -> bool:
+    '''Cheaply check whether a message might need translating, based on its subtopic and
+    a byte-level search for its "msg" type, without parsing it as JSON.
 
-def translate_packet(ws: websockets.sync.client.ClientConnection, pkt: mqttpacket._packet.MQTTPacket, current: float, last_sensor_temp: dict[str, float]) -> Optional[int]:
-    replied = None
+    False positives just mean that a message gets parsed unnecessarily, but there should
+    be no false negatives: if a "msg" key is anywhere in the payload, it will be found.'''
+    mt = _translated_msg_types.get(subtopic)
+    return mt is not None and mt in _msg_type_re.findall(payload)
 
+
+def is_command(did: str, subtopic: str, payload: dict) -> bool:
+    '''Check whether a message is a msg 44 command to the device, with only the checks that
+    translating it depends on. messages.Command checks every field (for displaying them), so
+    it fails on commands with unexpected extra fields or timestamps, which we still translate.'''
+    body = payload.get('body')
+    return (subtopic == 'in' and payload.get('msg') == 44 and payload.get('ver') == '1.0' and payload.get('resp') == 2
+            and payload.get('dest') == {'ref': did, 'type': 1} and isinstance(body, dict) and body.get('ver') == 1)
+
+
+def translate_packet(conn: 'mqtt.MqttConnection', pkt: 'mqttpacket._packet.MQTTPacket', current: float, last_sensor_temp: dict[str, float]):
     if isinstance(pkt, mqttpacket._packet.DisconnectPacket):
         logger.warning("Received MQTT disconnect from server")
     elif isinstance(pkt, mqttpacket.PublishPacket):
+        sw = profiling.Stopwatch()
         did, subtopic = pkt.topic.split('/')[-2:]
-        try:
-            payload = json.loads(pkt.payload, object_hook=slurpy, strict=False)
-        except json.JSONDecodeError as exc:
-            # Very rarely (every few days-weeks) I receive a packet with a
-            # malformed or incomplete JSON payload, something like:
-            #   '{"ver":"1.0","src":{"type": 1, "ref": "$DID"},"time":$UNIXTIME,"msg":44,"id":$RANDOM_HUGE_INTEGER, "resp_id":$UNIXTIMEMS, "body":'
-            # FIXME: should we ack such messages if their QOS is >0?
-            logger.warning(f"Received packet with non-JSON payload: {pkt.payload}", exc_info=exc)
-            return replied
-
-        if subtopic == 'in' and payload.get('msg') == 44:
+        if not might_need_translation(subtopic, pkt.payload):
+            # Nothing to translate, so don't bother parsing it; just acknowledge it
+            stats['skipped'] += 1
+            metrics.observe_unparsed(subtopic)
+            sw.lap('prefilter')
+            m, command = None, False
+        else:
+            stats['parsed'] += 1
+            sw.lap('prefilter')
+            try:
+                payload = messages.loads(pkt.payload)
+            except ValueError as exc:
+                # Very rarely (every few days-weeks) I receive a packet with a
+                # malformed or incomplete JSON payload, something like:
+                #   '{"ver":"1.0","src":{"type": 1, "ref": "$DID"},"time":$UNIXTIME,"msg":44,"id":$RANDOM_HUGE_INTEGER, "resp_id":$UNIXTIMEMS, "body":'
+                # FIXME: should we ack such messages if their QOS is >0?
+                logger.warning(f"Received packet with non-JSON payload: {pkt.payload}", exc_info=exc)
+                metrics.decode_failures.inc(stage='json')
+                sw.lap('json')
+                sw.done('(bad JSON)')
+                return
+
+            sw.lap('json')
+            try:
+                m = messages.decode(did, subtopic, payload)
+            except Exception as exc:
+                metrics.decode_failures.inc(stage='decode')
+                m, command = None, is_command(did, subtopic, payload)
+                if command:
+                    logger.debug(f"Received command packet with unexpected contents, translating it anyway: {pkt.payload}", exc_info=exc)
+                else:
+                    logger.warning(f"Received {subtopic!r} packet with unexpected contents, not translating it: {pkt.payload}", exc_info=exc)
+            else:
+                # Only for the messages which we parse (those which might need translating)
+                metrics.observe_message(m)
+                command = isinstance(m, messages.Command)
+            sw.lap('classify')
+
+        if command:
             # Setpoint message for BB-V2-0 device (we need to change $TYPE from 1 to 5):
             #
             # {"Timestamp": $UNIXTIME,
@@ -58,54 +126,43 @@ def translate_packet(ws: websockets.sync.client.ClientConnection, pkt: mqttpacke
             #  "time": $UNIXTIME,
             #  "ver": "1.0"}
 
-            assert payload.ver == "1.0"
-            assert payload.resp == 2
-            assert payload.dest == {'ref': did, 'type': 1}
-            body = payload.body
-            assert body.ver == 1
-            if body.type == 1:   # what the app sends for model BB-V1-1
-                body.type = 5    # ... what the model BB-V2-0-L actually wants
-                payload.id = int(time() * 1000)
-                payload.time = payload.Timestamp = payload.id // 1000
-                opkt = mqttpacket.publish(pkt.topic, pkt.dup, pkt.qos, pkt.retain, packet_id=pkt.packetid ^ 0x8000,
-                    payload=json.dumps(payload).encode())
-                logger.debug(f"Translated command packet for BB-V1-0 into BB-V2-0-L: {mqttpacket.parse_one(opkt)}")
-
-                ws.send(opkt)
-                replied = time()
-            elif body.type == 5:
+            body = payload['body']
+            assert body['ver'] == 1
+            if body['type'] == 1:   # what the app sends for model BB-V1-1
+                body['type'] = 5    # ... what the model BB-V2-0-L actually wants
+                payload['id'] = int(time() * 1000)
+                payload['time'] = payload['Timestamp'] = payload['id'] // 1000
+                opayload = json.dumps(payload).encode()
+                sw.lap('format')
+                logger.debug(f"Translated command packet for BB-V1-0 into BB-V2-0-L: {opayload}")
+
+                conn.publish_soon(pkt.topic, opayload, pkt.qos, pkt.retain)
+                stats['translated'] += 1
+            elif body['type'] == 5:
                 pass             # don't re-echo our own message
 
-        elif subtopic == 'batch' and payload.get('msg') == 3:
-            assert payload.ver == '1.0'
-            assert payload.src == {'ref': did, 'type': 1}
-            body = payload.body
-            readings = MysaReading.parse_readings(b64decode(body.readings))
-            if readings[0].ver == 0:
+        elif isinstance(m, messages.Readings):
+            body, raw = payload['body'], m.raw
+            if raw[2] == 0:
                 logger.debug(f'Saw already-translated-to-v0 readings packet')
             elif current is None:
                 logger.warning(f'Skipping translation of readings packet because no current level was specified.')
             else:
-                assert readings[0].ver == 3
-                lst = last_sensor_temp[did] = readings[-1].sensor_t  # stash latest SensorTemp so we can parrot it
+                assert raw[2] == 3
+                lst = last_sensor_temp[did] = MysaReading.last_reading(raw).sensor_t  # stash latest SensorTemp so we can parrot it
                 logger.debug(f"Snagged latest SensorTemp of {lst}°C from readings packet for BB-V2-0")
-                # FIXME: checksum=None is a hack to force it to be recalculated
-                newr = b''.join(
-                    bytes(MysaReadingV0(checksum=None, ver=0, **{
-                        k: getattr(r, k) for k, v in r.__dataclass_fields__.items()
-                        if k not in ('voltage', 'current', 'always0', 'ver', 'checksum')}))
-                    for r in readings)
-                body.readings = b64encode(newr).decode()
-                payload.id += 1
-                opkt = mqttpacket.publish(pkt.topic, pkt.dup, pkt.qos, pkt.retain,
-                    packet_id=pkt.packetid ^ 0x8000 if pkt.packetid else None,
-                    payload=json.dumps(payload).encode())
-                logger.debug(f"Translated readings packet for BB-V2-0 into BB-V1-0-L: {mqttpacket.parse_one(opkt)}")
-
-                ws.send(opkt)
-                replied = time()
-
-        elif subtopic == 'out' and payload.get('msg') == 40:
+                newr = transcode_readings_v3_to_v0(raw)
+                sw.lap('readings')
+                body['readings'] = b64encode(newr).decode()
+                payload['id'] += 1
+                opayload = json.dumps(payload).encode()
+                sw.lap('format')
+                logger.debug(f"Translated readings packet for BB-V2-0 into BB-V1-0-L: {opayload}")
+
+                conn.publish_soon(pkt.topic, opayload, pkt.qos, pkt.retain)
+                stats['translated'] += 1
+
+        elif isinstance(m, messages.Status) and m.msg_type == 40:
             if current is None:
                 logger.warning(f'Skipping translation of device state packet because no current level was specified.')
 
@@ -118,8 +175,6 @@ def translate_packet(ws: websockets.sync.client.ClientConnection, pkt: mqttpacke
             #  "time": $UNIXTIME,
             #  "ver": "1.0"}
 
-            assert payload.ver == "1.0"
-
             # Device state message from BB-V1-1 devices:
             #
             # {"ComboTemp": 20.93,          # = "SensorTemp" in /devices/state
@@ -133,31 +188,67 @@ def translate_packet(ws: websockets.sync.client.ClientConnection, pkt: mqttpacke
             # "ThermistorTemp": 0.0,
             # "Timestamp": $UNIXTIME}
 
-            opkt = mqttpacket.publish(pkt.topic, pkt.dup, pkt.qos, pkt.retain,
-                packet_id=pkt.packetid ^ 0x8000 if pkt.packetid else None,
-                payload=json.dumps({
-                    "ComboTemp": last_sensor_temp.get(did, 0.0),   # whatever we got last
-                    "Current": None if current is None else current * payload.body.get('dtyCycle', 1.0),
-                    "Device": did,
-                    "Humidity": payload.body.get('hum', 0.0),
-                    "MainTemp": payload.body.get('ambTemp', 0.0),
-                    "MsgType": 0,
-                    "SetPoint": payload.body.get('stpt', 0.0),
-                    "Stream": 1,
-                    "ThermistorTemp": 0.0,
-                    "Timestamp": payload.time,
-            }).encode())
-            logger.debug(f"Translated device state packet from BB-V2-0-L into BB-V1-1: {mqttpacket.parse_one(opkt)}")
-
-            ws.send(opkt)
-            replied = time()
+            opayload = json.dumps({
+                "ComboTemp": last_sensor_temp.get(did, 0.0),   # whatever we got last
+                "Current": None if current is None else current * m.body.get('dtyCycle', 1.0),
+                "Device": did,
+                "Humidity": m.body.get('hum', 0.0),
+                "MainTemp": m.body.get('ambTemp', 0.0),
+                "MsgType": 0,
+                "SetPoint": m.body.get('stpt', 0.0),
+                "Stream": 1,
+                "ThermistorTemp": 0.0,
+                "Timestamp": m.ts,
+            }).encode()
+            sw.lap('format')
+            logger.debug(f"Translated device state packet from BB-V2-0-L into BB-V1-1: {opayload}")
+
+            conn.publish_soon(pkt.topic, opayload, pkt.qos, pkt.retain)
+            stats['translated'] += 1
 
         if pkt.qos > 0:
-            ws.send(p := mqttpacket.puback(pkt.packetid))
+            conn.send(mqttpacket.puback(pkt.packetid))
             logger.debug(f"Sent PUBACK packet for packet_id={pkt.packetid}")
-            replied = time()
-
-    return replied
+        sw.lap('send')
+        sw.done('(not parsed)' if m is None else type(m).__name__)
+
+
+def set_models(sess: requests.Session, devices: list[str], model: str, current: Optional[float] = None,
+               retries: int = 3, max_workers: int = 8) -> dict[str, Optional[Exception]]:
+    '''Change the model of several devices concurrently, with POST /devices/{did}, retrying
+    each device (with exponential backoff) on connection errors and server errors.
+
+    Returns {did: None on success, or the exception from the last attempt}'''
+    body = {'Model': model}
+    if current is not None:
+        body.update(MaxCurrent=current, Current=current)  # do I need/want both?
+
+    def post(did):
+        for attempt in range(retries):
+            try:
+                r = sess.post(f'{BASE_URL}/devices/{did}', json=body, timeout=10)
+                r.raise_for_status()
+                return None
+            except requests.RequestException as exc:
+                if isinstance(exc, requests.HTTPError) and exc.response.status_code < 500 or attempt + 1 == retries:
+                    return exc
+                logger.warning(f'Setting model of {did} to {model} failed ({exc}), retrying...')
+                sleep(0.5 * 2 ** attempt)
+
+    if not devices:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(devices))) as pool:
+        return dict(zip(devices, pool.map(post, devices)))
+
+
+def report_models(results: dict[str, Optional[Exception]], model: str) -> bool:
+    '''Print which devices were (and weren't) set to the model, and return True if all were'''
+    for did, exc in results.items():
+        if exc is None:
+            print(f'Set Mysa thermostat {did} to model {model}')
+        else:
+            print(f'FAILED to set Mysa thermostat {did} to model {model}: {exc}', file=stderr)
+    return all(exc is None for exc in results.values())
 
 
 def main(args=None):
@@ -174,6 +265,11 @@ def main(args=None):
     p.add_argument('-d', '--device', action='append', type=lambda s: s.replace(':','').lower(), help='Specific device (MAC address)')
     p.add_argument('-C', '--current', type=float, help="Estimated max current level (in Amperes). Mysa V2 Lite devices don't have current sensors.")
     p.add_argument('-R', '--reset', action='store_true', help='Just reset faked Mysa Lite devices, and exit')
+    p.add_argument('--subscribe-chunk', type=int, default=3, metavar='N', help='Maximum number of MQTT topics per SUBSCRIBE packet (default %(default)s)')
+    p.add_argument('--metrics', metavar='ADDR',
+                   help='Serve metrics (Prometheus text format) over HTTP at /metrics, at HOST:PORT or a Unix socket path')
+    p.add_argument('--profile', action='store_true', help='Profile the proxy with cProfile and tracemalloc (dumped along with stage timings on SIGUSR1, and on exit)')
+    p.add_argument('--subscribe-window', type=int, default=4, metavar='N', help='Maximum number of SUBSCRIBE packets awaiting SUBACK at once (default %(default)s)')
     args = p.parse_args(args)
 
     # Authenticate with pycognito
@@ -187,6 +283,8 @@ def main(args=None):
     sess = requests.Session()
     sess.auth = mysa_stuff.auther(u)
     sess.headers.update(mysa_stuff.CLIENT_HEADERS)
+    # Enough pooled connections for set_models to change all the devices' models at once
+    sess.mount('https://', HTTPAdapter(pool_maxsize=16))
 
     # The /users endpoint gives the "real" device models, even after faking them in /devices
     # so it gracefully handles BB-V2-0-L devices that weren't cleanly reset after running liten-up
@@ -215,11 +313,7 @@ def main(args=None):
                 print(f'  {did}: {devicesobj[did].Name}')
 
     if args.reset:
-        for did in devices:
-            r = sess.post(f'{BASE_URL}/devices/{did}', json={'Model': 'BB-V2-0-L'})
-            r.raise_for_status()
-            print(f'Restored Mysa thermostat {args.device} to model BB-V2-0-L')
-        p.exit(0)
+        p.exit(0 if report_models(set_models(sess, devices, 'BB-V2-0-L'), 'BB-V2-0-L') else 1)
 
     # Check firmware versions
     r = sess.get(f'{BASE_URL}/devices/firmware')
@@ -240,7 +334,18 @@ def main(args=None):
 
     # Connect to MQTT-over-WebSockets endpoint
     cid = str(uuid1())
-    try:
+
+    async def proxy():
+        nonlocal u
+        # kill -USR1 dumps packet handling stage timings
+        profiling.dump_on_signal()
+        signed_mqtt_url, signed_at, refetch_credentials = None, None, False
+        backoff, disconnected_at = 0, None
+        subscribe_chunk, subscribe_window, subscribed = args.subscribe_chunk, args.subscribe_window, False
+        if args.metrics:
+            await metrics.serve(args.metrics)
+            metrics.counter_collector(metrics.translations, stats, 'result')
+            metrics.counter_collector(metrics.mqtt_events, mqtt.stats, 'event')
         while True:
             # FIXME: abstract this away into mysotherm.auth.reauth, or something like that?
             if (exp_in := time() - u.id_claims['exp']) > -60:
@@ -259,76 +364,100 @@ def main(args=None):
                         sess.auth = mysa_stuff.auther(u)
                         logger.info('Cognito reauthenticated.')
 
-
-            cred = u.get_credentials(identity_pool_id=mysa_stuff.IDENTITY_POOL_ID)
-            signed_mqtt_url = mysa_stuff.sigv4_sign_mqtt_url(cred)
-            urlp = urlparse(signed_mqtt_url)
-            with websockets.sync.client.connect(
-                urlp._replace(scheme='wss').geturl(),
-                subprotocols=('mqtt',),
-                # Seemingly not necessary for the server, but Mysa official client adds all this:
-                origin=urlp._replace(path='', params='', query='', fragment='').geturl(),
-                additional_headers={'accept-encoding': 'gzip'},
-                user_agent_header=sess.headers['user-agent'],
-            ) as ws:
-                connected_at = time()
-                ws.send(mqttpacket.connect(cid), 60)
-                timeout = time() + 60
-                pkt = mqttpacket.parse_one(ws.recv())
-                assert isinstance(pkt, mqttpacket.ConnackPacket)
-
-                # Subscribe to feeds for these devices
-                for ii, did in enumerate(devices, 1):
-                    ws.send(mqttpacket.subscribe(ii, [
-                        mqttpacket.SubscriptionSpec(f'/v1/dev/{did}/out', 0x01),
-                        mqttpacket.SubscriptionSpec(f'/v1/dev/{did}/in', 0x01),
-                        mqttpacket.SubscriptionSpec(f'/v1/dev/{did}/batch', 0x01)
-                        ]))
-                    timeout = time() + 60
-                    pkt = mqttpacket.parse_one(ws.recv())
-                    assert isinstance(pkt, mqttpacket.SubackPacket) and pkt.packet_id == ii
-
-                # Do the "magic upgrades"
+            # Reuse the signed URL while it and the AWS credentials in it are still valid
+            aws_cred = u.aws_credentials
+            if (signed_mqtt_url is None or time() - signed_at > SIGNED_URL_REUSE
+                    or aws_cred is None or aws_cred['Expiration'].timestamp() - time() < 300):
+                cred = u.get_credentials(identity_pool_id=mysa_stuff.IDENTITY_POOL_ID, force=refetch_credentials)
+                signed_mqtt_url, signed_at, refetch_credentials = mysa_stuff.sigv4_sign_mqtt_url(cred), time(), False
+
+            try:
+                # A persistent session (with our stable client ID) keeps our subscriptions across reconnections
+                conn = await mqtt.MqttConnection.connect(signed_mqtt_url, cid, sess.headers['user-agent'], clean_session=False)
+            except (OSError, asyncio.TimeoutError, ws_exceptions.WebSocketException, mqtt.ConnectionRefused) as exc:
+                # The signed URL or the (cached) AWS credentials in it might be the problem (e.g. 403
+                # Forbidden, or CONNACK "not authorized"), so don't reuse either of them next time
+                signed_mqtt_url, refetch_credentials = None, True
+                backoff = min(max(backoff * 2, 1), 60)
+                delay = random.uniform(backoff / 2, backoff)
+                logger.warning(f'MQTT connection failed ({exc!r}), retrying in {delay:.1f}s...')
+                await asyncio.sleep(delay)
+                continue
+
+            async with conn:
+                if conn.session_present and subscribed:
+                    logger.info('MQTT session (with subscriptions) resumed.')
+                else:
+                    # Subscribe to feeds for these devices
+                    try:
+                        await conn.subscribe_devices(devices, subscribe_chunk, subscribe_window)
+                    except ws_exceptions.ConnectionClosed:
+                        # The session may have only some of the subscriptions, so resubscribe to all of them, in smaller packets
+                        subscribed = False
+                        subscribe_chunk, subscribe_window = mqtt.MqttConnection.smaller_subscribe(subscribe_chunk, subscribe_window)
+                        backoff = min(max(backoff * 2, 1), 60)
+                        delay = random.uniform(backoff / 2, backoff)
+                        logger.warning(f'MQTT connection closed while subscribing, retrying with {subscribe_chunk} topics '
+                                       f'per SUBSCRIBE and {subscribe_window} at once in {delay:.1f}s...')
+                        mqtt.stats['subscribe_drops'] += 1
+                        await asyncio.sleep(delay)
+                        continue
+                    subscribed = True
+
+                # Do the "magic upgrades", for devices that don't already have them
                 # This is what causes the Mysa apps to treat these devices as BB-V1-1
-                for did in devices:
-                    r = sess.post(f'{BASE_URL}/devices/{did}', json=
-                        {'Model': 'BB-V1-1', 'MaxCurrent': args.current, 'Current': args.current}   # do I need/want both?
-                    r.raise_for_status()
+                r = await asyncio.to_thread(sess.get, f'{BASE_URL}/devices')
+                r.raise_for_status()
+                devicesobj = r.json(object_hook=slurpy).DevicesObj
+                todo = [did for did in devices if devicesobj.get(did, {}).get('Model') != 'BB-V1-1']
+                results = await asyncio.to_thread(set_models, sess, todo, 'BB-V1-1', args.current)
+                if failed := [did for did, exc in results.items() if exc is not None]:
+                    raise RuntimeError(f'Failed to set model of {", ".join(failed)} to BB-V1-1: {results[failed[0]]}')
+
+                if disconnected_at is not None:
+                    mqtt.stats['reconnects'] += 1
+                    logger.info(f'Reconnected in {monotonic() - disconnected_at:.1f}s' +
+                                (' (resumed MQTT session)' if conn.session_present else ''))
 
                 try:
                     # Await messages and translate as needed
-                    while True:
-                        try:
-                            pkt = mqttpacket.parse_one(ws.recv(timeout - time()))
-                        except TimeoutError:
-                            pass
-                        else:
-                            logger.debug(f'Received packet: {pkt}')
-                            replied = translate_packet(ws, pkt, args.current, last_sensor_temp)
-                            if replied is not None:
-                                timeout = replied + 60
-
-                        if time() > timeout:
-                            ws.send(mqttpacket.pingreq())
-                            logger.debug(f"Sent PINGREQ keepalive packet")
-                            timeout = time() + 60
-
-                except websockets.exceptions.ConnectionClosed as exc:
-                    print(f"Websockets connection closed after {int(time() - connected_at)}s (rcvd={exc.rcvd}, sent={exc.sent})...")
-
-                except KeyboardInterrupt:
-                    print(f"Got interrupt (Ctrl-C) after {int(time() - connected_at)} s...")
-                    break
+                    async for pkt in conn:
+                        translate_packet(conn, pkt, args.current, last_sensor_temp)
+
+                except ws_exceptions.ConnectionClosed as exc:
+                    print(f"Websockets connection closed after {int(monotonic() - conn.connected_at)}s (rcvd={exc.rcvd}, sent={exc.sent})...")
+                finally:
+                    print(f"Translated messages: {conn.publish_report()}")
+                    disconnected_at = monotonic()
+
+            # Reconnect right away after a long-lived connection, otherwise back off
+            if disconnected_at - conn.connected_at > 60:
+                backoff = 0
+            else:
+                backoff = min(max(backoff * 2, 1), 60)
+                delay = random.uniform(backoff / 2, backoff)
+                logger.info(f'Connection was short-lived, reconnecting in {delay:.1f}s...')
+                await asyncio.sleep(delay)
 
+    profiling.install(args.profile)
+    try:
+        asyncio.run(proxy())
+    except KeyboardInterrupt:
+        print("Got interrupt (Ctrl-C)...")
     finally:
+        if args.profile:
+            profiling.dump()
+        if total := stats['skipped'] + stats['parsed']:
+            print(f"Passed through {stats['skipped']}/{total} messages without parsing them; parsed {stats['parsed']}, "
+                  f"of which {stats['translated']} needed translating ({stats['parsed'] - stats['translated']} parsed unnecessarily).")
         if u.id_claims['exp'] < time() + 60:
             print(f'Renewing auth tokens in order to restore Mysa V2 Lite thermostats...')
             u.renew_access_token()
         print(f'Restoring Mysa V2 Lite thermostats to normal state...')
-        for did in devices:
-            r = sess.post(f'{BASE_URL}/devices/{did}', json={'Model': 'BB-V2-0-L'})
-            r.raise_for_status()
-            print(f'Restored Mysa thermostat {did} to model BB-V2-0-L')
+        # All at once, so that the devices spend as little time as possible in the faked state. (The
+        # POSTs run in worker threads, which will finish even if this is interrupted by Ctrl-C.)
+        if not report_models(set_models(sess, devices, 'BB-V2-0-L'), 'BB-V2-0-L'):
+            print(f'Run {p.prog} --reset to retry restoring the failed devices.', file=stderr)
 
 
 if __name__ == '__main__':
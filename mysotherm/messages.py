@@ -0,0 +1,347 @@
+'''
+Decoding of the JSON messages which Mysa devices and apps publish to the
+/v1/dev/$DID/{in,out,batch} MQTT topics.
+
+There are two schemas: older messages have a "MsgType" field, and newer ones
+have "msg", "ver", "src"/"dest", "time" and "body" fields. Each known combination
+of (schema, message type, subtopic) is registered to a Message subclass, so
+dispatching a message is a single dict lookup, regardless of how many message
+types are known.
+
+Decoding checks each message against what we've seen before (with asserts),
+and pops the fields it understands, leaving any others in `rest`.
+'''
+from base64 import b64decode
+import json
+from typing import Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from .mysa_stuff import MysaReading
+
+_registry: dict[tuple[str, int, str], type['Message']] = {}
+
+
+def register(schema: str, msg_types, subtopic: str):
+    '''Class decorator to handle messages of one or more types, for one schema and subtopic'''
+    def deco(cls):
+        for mt in (msg_types if isinstance(msg_types, tuple) else (msg_types,)):
+            key = (schema, mt, subtopic)
+            assert key not in _registry, f'Duplicate handlers for {key}'
+            _registry[key] = cls
+        return cls
+    return deco
+
+
+def loads(payload: bytes):
+    '''Parse a JSON message payload into plain dicts and lists, with orjson if it's installed.
+
+    Falls back to the standard library parser with strict=False, which tolerates the
+    unescaped control characters that some messages contain.'''
+    if orjson is not None:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(payload, strict=False)
+
+
+def decode(did: str, subtopic: str, payload: dict) -> 'Message':
+    '''Decode the (already JSON-parsed) payload of a message published to /v1/dev/$DID/$SUBTOPIC.
+
+    The payload itself is not modified.'''
+    if (mt := payload.get('msg')) is not None:
+        schema = 'msg'
+    elif (mt := payload.get('MsgType')) is not None:
+        schema = 'MsgType'
+    else:
+        return Message(did, subtopic, payload)
+    return _registry.get((schema, mt, subtopic), Message)(did, subtopic, payload, mt)
+
+
+class Message:
+    '''A message that isn't understood (or a base class for those which are)'''
+    __slots__ = ('did', 'subtopic', 'payload', 'msg_type', 'ts', 'rest')
+
+    recheck_delay: Optional[float] = None
+    """If not None, device state should be requeried from the JSON API this long after the message"""
+
+    def __init__(self, did: str, subtopic: str, payload: dict, msg_type: Optional[int] = None):
+        self.did = did
+        self.subtopic = subtopic
+        self.payload = payload
+        self.msg_type = msg_type
+        self.ts = None
+        self.rest = dict(payload)
+        self._decode(self.rest)
+
+    def _decode(self, j: dict):
+        pass
+
+    @property
+    def recheck_at(self) -> Optional[float]:
+        return None if self.recheck_delay is None or self.ts is None else self.ts + self.recheck_delay
+
+    def describe(self, user_id: Optional[str] = None) -> Optional[str]:
+        '''Human-readable description of the message, or None if not understood'''
+        return None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(did={self.did!r}, subtopic={self.subtopic!r}, ts={self.ts!r})'
+
+
+### Older "MsgType" schema
+
+class LegacyMessage(Message):
+    __slots__ = ()
+    template = '{rest}'
+
+    def _decode(self, j: dict):
+        del j['MsgType']
+        if 'device' in j and 'timestamp' in j:
+            # newer firmware (?) sends lowercase version for some messages
+            assert j.pop('device') == self.did
+            self.ts = j.pop('timestamp')
+        else:
+            assert j.pop('Device') == self.did
+            self.ts = j.pop('Timestamp')
+        self._decode_fields(j)
+
+    def _decode_fields(self, j: dict):
+        pass
+
+    def describe(self, user_id=None):
+        return self.template.format(self=self, rest=json.dumps(self.rest))
+
+
+@register('MsgType', 11, 'in')
+class PublishStatusRequest(LegacyMessage):
+    __slots__ = ()
+    template = 'App telling device to publish its status ({rest})'
+
+
+@register('MsgType', 6, 'in')
+class CheckSettingsRequest(LegacyMessage):
+    __slots__ = ()
+    template = 'App telling device to check its settings ({rest})'
+    recheck_delay = 0
+
+
+@register('MsgType', 7, 'in')
+class DumpReadingsRequest(LegacyMessage):
+    __slots__ = ()
+    template = 'App telling device to dump its readings ({rest})'
+
+
+@register('MsgType', 40, 'in')
+class KillerPing(LegacyMessage):
+    __slots__ = ('echo_id',)
+    template = 'Killer ping command with EchoID={self.echo_id} ({rest})'
+
+    def _decode_fields(self, j):
+        self.echo_id = j.pop('EchoID')
+
+
+@register('MsgType', 5, 'out')
+class KillerPingResponse(KillerPing):
+    __slots__ = ()
+    template = 'Killer ping response ({rest})'
+
+
+@register('MsgType', 4, 'out')
+class DeviceLog(LegacyMessage):
+    __slots__ = ('level', 'message')
+    template = 'Device log [{self.level}] {self.message} ({rest})'
+
+    def _decode_fields(self, j):
+        self.level, self.message = j.pop('Level'), j.pop('Message')
+
+
+@register('MsgType', 0, 'out')
+class LegacyStatus(LegacyMessage):
+    __slots__ = ()
+    template = 'Device (V1?) reporting its status: {rest}'
+
+    def _decode_fields(self, j):
+        assert j.pop('Stream') == 1
+
+
+@register('MsgType', 1, 'out')
+class PrevNext(LegacyMessage):
+    __slots__ = ()
+    template = 'Unclear prev/next message from device: {rest}'
+
+
+@register('MsgType', 10, 'out')
+class PostBoot(LegacyMessage):
+    __slots__ = ()
+    template = 'Post-boot message: {rest}'
+
+
+@register('MsgType', 20, 'in')
+class MsgType20(LegacyMessage):
+    __slots__ = ()
+    template = 'Unknown MsgType=20, might be "check your status" similar to MsgType=6 ({rest})'
+    recheck_delay = 0
+
+
+### Newer "msg" schema
+
+def _pop_device_src(j: dict, did: str):
+    assert j.pop('ver') == '1.0'
+    assert j.pop('src') == {'ref': did, 'type': 1}
+
+
+@register('msg', (40, 17, 16), 'out')
+class Status(Message):
+    __slots__ = ('body',)
+    guesses = {40: 'V2?', 17: 'V1-INF?', 16: 'weird msg=16 from V1-INF?'}
+
+    def _decode(self, j):
+        del j['msg']
+        _pop_device_src(j, self.did)
+        self.ts = j.pop('time')
+        self.body = j.pop('body')
+
+    def describe(self, user_id=None):
+        return f'Device ({self.guesses[self.msg_type]}) reporting its status: {json.dumps(self.body)}'
+
+
+@register('msg', 44, 'in')
+class Command(Message):
+    __slots__ = ('src', 'body', 'stringified_cmd')
+
+    def _decode(self, j):
+        del j['msg']
+        self.ts = j.pop('id') / 1000
+        assert j.pop('ver') == '1.0'
+        assert j.pop('dest') == {'ref': self.did, 'type': 1}
+        assert j.pop('resp') == 2
+        assert abs(j.pop('Timestamp') - int(self.ts)) <= 1   # Sometimes randomly off by 1 sec
+        assert j.pop('time') == int(self.ts)
+        # This 'timestamp'/'Timestamp' thing was due to my mistake in liten-up
+        assert 'timestamp' not in j
+        self.src = j.pop('src')
+        assert set(j.keys()) == {'body'}
+        self.body = body = dict(j.pop('body'))
+        assert body.pop('ver')
+        self.stringified_cmd = isinstance(body['cmd'], str)
+        if self.stringified_cmd:
+            body['cmd'] = json.loads(body['cmd'])
+
+    def describe(self, user_id=None):
+        if self.src == {'ref': user_id, 'type': 100}:
+            by = 'You'
+        elif self.src['type'] == 100:
+            by = f'Other user {self.src["ref"]}'
+        else:
+            by = json.dumps(self.src)
+        weird = ' (derpy stringified cmd)' if self.stringified_cmd else ''
+        return f'{by} commanding device{weird}: {json.dumps(self.body)}'
+
+
+@register('msg', 44, 'out')
+class CommandResponse(Message):
+    __slots__ = ('id', 'body')
+    trig_srcs = {3: 'app command', 1: 'buttons'}
+
+    def _decode(self, j):
+        del j['msg']
+        self.ts = j.pop('time')
+        _pop_device_src(j, self.did)
+        assert abs(self.ts - j.pop('resp_id') / 1000) <= 5  # <=5 sec delay
+        self.id = j.pop('id')
+        self.body = body = dict(j.pop('body'))
+        assert not j
+        assert body.pop('success') == 1
+
+    def describe(self, user_id=None):
+        cmd_src = self.trig_srcs.get(self.body.get('trig_src'), 'command of unknown trig_src')
+        return f'Device responding to {cmd_src}: {json.dumps(self.body)} (id={self.id})'
+
+
+@register('msg', 34, 'in')
+class Schedule(Message):
+    __slots__ = ('id', 'src_ref', 'hash', 'events', 'total_events', 'create_time')
+
+    def _decode(self, j):
+        del j['msg']
+        self.ts = j.pop('time')
+        assert j.pop('ver') == '1.0'
+        assert j.pop('dest') == {'ref': self.did, 'type': 1}
+        self.id = j.pop('id')
+        src = dict(j.pop('src'))
+        assert src.pop('type') == 302
+        self.src_ref = src.pop('ref')
+        assert not src
+        body = dict(j.pop('body'))
+        assert not j
+        assert body.pop('ver') == '3.0.0'
+        self.hash = body.pop('hash')
+        self.events = body.pop('events')
+        self.total_events = body.pop('totalEvents')
+        if self.events:
+            assert len(self.events) <= self.total_events
+            self.create_time = body.pop('createTime')
+            assert self.hash
+            assert self.src_ref
+        else:
+            assert self.total_events == 0
+            # assert not self.hash    # usually empty, but not always
+            assert not self.src_ref
+            self.create_time = None
+        assert not body
+
+    def describe(self, user_id=None):
+        if self.events:
+            return (f'Set schedule (source {self.src_ref}, createTime {self.create_time}, hash {self.hash}), '
+                    f'{len(self.events)}/{self.total_events} events: {self.events}')
+        else:
+            return f'Delete schedule (hash {self.hash!r})'
+
+
+@register('msg', 61, 'out')
+class Boot(Message):
+    __slots__ = ('id', 'fw')
+
+    def _decode(self, j):
+        del j['msg']
+        assert j.pop('time') == 0
+        _pop_device_src(j, self.did)
+        self.id = j.pop('id')
+        body = dict(j.pop('body'))
+        assert not j
+        self.fw = body.pop('fw')
+        assert not body
+
+    def describe(self, user_id=None):
+        return f'Device boot-up message with firmware version {self.fw}'
+
+
+@register('msg', 3, 'batch')
+class Readings(Message):
+    __slots__ = ('id', 'raw', '_readings')
+    recheck_delay = 60
+
+    def _decode(self, j):
+        del j['msg']
+        self.ts = j.pop('time')
+        _pop_device_src(j, self.did)
+        self.id = j.pop('id')
+        body = dict(j.pop('body'))
+        assert not j
+        self.raw = b64decode(body.pop('readings'))
+        assert not body
+        self._readings = None
+
+    @property
+    def readings(self) -> list[MysaReading]:
+        if self._readings is None:
+            self._readings = MysaReading.parse_readings(self.raw)
+        return self._readings
+
+    def describe(self, user_id=None):
+        return f'Raw readings (v{self.readings[0].ver}):\n' + ''.join(f'  {r}\n' for r in self.readings)
@@ -0,0 +1,203 @@
+'''
+Metrics in the Prometheus text exposition format, served over HTTP with --metrics.
+
+There are per-device gauges (of the latest values from decoded MQTT messages), and
+counters and histograms of the internals (message counts, decode failures, MQTT
+keepalives and reconnections, and end-to-end message lag).
+
+Internals that already count things in a Counter (e.g. mysotherm.mqtt.stats) are
+copied into the metrics by "collectors", which run just before the metrics are rendered.
+
+https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+'''
+from bisect import bisect_left
+import math
+from time import time
+from typing import Callable, Optional
+
+from . import messages
+from .mysa_stuff import MysaReading
+from .twin import state_fields
+from .util import serve_http
+
+enabled = False
+"""Whether to collect per-message metrics (set when the metrics are served)"""
+
+_families: list['Metric'] = []
+collectors: list[Callable[[], None]] = []
+"""Called before rendering, to update metrics from counts kept elsewhere"""
+
+
+def _escape(v) -> str:
+    return str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(labels: tuple) -> str:
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}' if labels else ''
+
+
+def _value(v: float) -> str:
+    return '+Inf' if v == math.inf else repr(float(v))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: dict[tuple, float] = {}
+        _families.append(self)
+
+    def set(self, value: float, **labels):
+        self.values[tuple(labels.items())] = value
+
+    def render(self) -> list[str]:
+        return [f'{self.name}{_labels(k)} {_value(v)}' for k, v in self.values.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        k = tuple(labels.items())
+        self.values[k] = self.values.get(k, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...]):
+        super().__init__(name, help)
+        self.buckets = buckets + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        k = tuple(labels.items())
+        if (h := self.values.get(k)) is None:
+            h = self.values[k] = [[0] * len(self.buckets), 0.0, 0]
+        h[0][bisect_left(self.buckets, value)] += 1
+        h[1] += value
+        h[2] += 1
+
+    def render(self) -> list[str]:
+        lines = []
+        for k, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for le, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{_labels(k + (("le", _value(le)),))} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(k)} {_value(total)}')
+            lines.append(f'{self.name}_count{_labels(k)} {count}')
+        return lines
+
+
+def render() -> bytes:
+    for collect in collectors:
+        collect()
+    lines = []
+    for m in _families:
+        if m.values:
+            lines += [f'# HELP {m.name} {m.help}', f'# TYPE {m.name} {m.kind}', *m.render()]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+async def serve(address: str) -> 'asyncio.AbstractServer':
+    '''Serve the metrics over HTTP at /metrics, on HOST:PORT or on a Unix socket (if address contains a "/")'''
+    global enabled
+    enabled = True
+
+    def respond(path):
+        if path in ('', '/metrics'):
+            return '200 OK', 'text/plain; version=0.0.4; charset=utf-8', render()
+        return '404 Not Found', 'text/plain', b'Not Found\n'
+
+    return await serve_http(address, respond, 'metrics')
+
+
+def counter_collector(metric: Counter, counts: 'collections.Counter', label: str, **labels):
+    '''Copy the counts of a collections.Counter into a Counter metric, with the keys as the values of a label'''
+    def collect():
+        for k, n in counts.items():
+            metric.set(n, **labels, **{label: k})
+    collectors.append(collect)
+
+
+### Per-device gauges
+
+temperature = Gauge('mysa_temperature_celsius', 'Latest temperature reported by the device, by sensor')
+setpoint = Gauge('mysa_setpoint_celsius', 'Latest setpoint reported by the device')
+humidity = Gauge('mysa_humidity_percent', 'Latest relative humidity reported by the device')
+duty = Gauge('mysa_duty_ratio', 'Latest duty cycle (0-1) reported by the device')
+current = Gauge('mysa_current_amperes', 'Latest current reported by the device')
+voltage = Gauge('mysa_voltage_volts', 'Latest line voltage reported by the device')
+rssi = Gauge('mysa_rssi_dbm', 'Latest WiFi signal strength reported by the device')
+last_message = Gauge('mysa_last_message_timestamp_seconds', 'Time of the latest message from or to the device')
+
+# /devices/state field names (see mysotherm.twin) -> gauge, and any extra labels
+STATE_GAUGES = {
+    'SensorTemp': (temperature, {'sensor': 'sensor'}),
+    'CorrectedTemp': (temperature, {'sensor': 'corrected'}),
+    'Infloor': (temperature, {'sensor': 'floor'}),
+    'SetPoint': (setpoint, {}),
+    'Humidity': (humidity, {}),
+    'Duty': (duty, {}),
+    'InstantCurrent': (current, {}),
+    'LineVoltage': (voltage, {}),
+}
+
+### Internals
+
+messages_total = Counter('mysa_messages_total', 'MQTT messages received, by subtopic and decoded message type')
+decode_failures = Counter('mysa_message_decode_failures_total', 'MQTT message payloads which could not be handled, by stage '
+                          '(json: not valid JSON, decode: unexpected contents, handle: failed after decoding)')
+checksum_failures = Counter('mysa_reading_checksum_failures_total', 'Raw readings from devices with bad checksums')
+message_lag = Histogram('mysa_message_lag_seconds', 'Time from message timestamp to receipt, by subtopic',
+                        (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900))
+mqtt_events = Counter('mysa_mqtt_events_total', 'MQTT connection events (connects, reconnects, PINGREQs sent)')
+translations = Counter('mysa_translate_messages_total', 'Messages seen by liten-up (skipped without parsing, parsed, translated)')
+
+
+def observe_message(m: messages.Message, received: Optional[float] = None):
+    '''Update metrics from a decoded MQTT message (if metrics are enabled)'''
+    if not enabled:
+        return
+
+    received = received or time()
+    messages_total.inc(subtopic=m.subtopic, type=type(m).__name__)
+    last_message.set(received, device=m.did)
+    if m.ts:   # some messages have zero timestamps
+        message_lag.observe(received - m.ts, subtopic=m.subtopic)
+
+    for field, v in state_fields(m):
+        if (g := STATE_GAUGES.get(field)) and isinstance(v, (int, float)):
+            g[0].set(v, device=m.did, **g[1])
+
+    if isinstance(m, messages.Readings):
+        if bad := sum(not r.checksum_good for r in m.readings):
+            checksum_failures.inc(bad, device=m.did)
+        if m.readings:
+            observe_reading(m.did, m.readings[-1])
+
+
+def observe_unparsed(subtopic: str):
+    '''Count a message which was passed through without parsing it (if metrics are enabled)'''
+    if enabled:
+        messages_total.inc(subtopic=subtopic, type='(not parsed)')
+
+
+def observe_reading(did: str, r: MysaReading):
+    temperature.set(r.sensor_t, device=did, sensor='sensor')
+    temperature.set(r.ambient_t, device=did, sensor='ambient')
+    temperature.set(r.heatsink_t, device=did, sensor='heatsink')
+    setpoint.set(r.setpoint_t, device=did)
+    humidity.set(r.humidity, device=did)
+    duty.set(r.duty / 100, device=did)
+    rssi.set(r.rssi, device=did)
+    if (v := getattr(r, 'voltage', None)) is not None:
+        voltage.set(v, device=did)
+    if (a := getattr(r, 'current', None)) is not None:
+        current.set(a / 1000, device=did)
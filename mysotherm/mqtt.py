@@ -0,0 +1,430 @@
+'''
+Asyncio client for MQTT 3.1.1 over WebSockets, as used by Mysa's AWS IoT endpoint.
+
+The MqttConnection object owns the CONNECT/CONNACK, SUBSCRIBE/SUBACK and PINGREQ
+keepalive parts of the MQTT lifecycle, each running as its own task, so that
+slow message handling or REST side-calls don't hold up keepalives or other
+devices' messages.
+
+The MqttPool object spreads devices over several such connections.
+'''
+import asyncio
+from collections import Counter, deque
+import logging
+import struct
+from time import monotonic, perf_counter
+from typing import Callable, Iterable, Optional
+from urllib.parse import urlparse
+import zlib
+
+from websockets.asyncio.client import connect as ws_connect, ClientConnection
+import websockets.exceptions
+import mqttpacket.v311 as mqttpacket
+
+from . import mysa_stuff
+from .profiling import stages
+
+logger = logging.getLogger(__name__)
+
+stats = Counter()
+"""Counts of MQTT connection events, across all connections: 'connects', 'reconnects' and 'pingreqs' (keepalives sent)"""
+
+
+class ConnectionRefused(Exception):
+    '''The broker refused an MQTT connection, with a nonzero CONNACK return code (e.g. 5, not
+    authorized, when the credentials in the signed URL have expired)'''
+    def __init__(self, return_code: int):
+        super().__init__(f'MQTT connection refused with CONNACK return code {return_code}')
+        self.return_code = return_code
+
+
+def _persistent_connect(client_id: str, keepalive: int) -> bytes:
+    '''MQTT 3.1.1 CONNECT packet with the Clean Session flag unset (mqttpacket.connect always sets it)'''
+    cid = client_id.encode()
+    body = struct.pack(f'>H4sBBHH{len(cid)}s', 4, b'MQTT', 4, 0, keepalive, len(cid), cid)
+    assert len(body) < 128  # so that the remaining length is a single byte
+    return bytes((0x10, len(body))) + body
+
+
+class MqttConnection:
+    max_inflight = 16
+    """Maximum number of QoS 1 PUBLISH packets (sent with publish()) awaiting PUBACK at once"""
+
+    retransmit_after = 10.0
+    """Seconds to wait for a PUBACK before resending a PUBLISH with the DUP flag"""
+
+    max_retransmits = 3
+
+    connack_timeout = 30.0
+    """Seconds to wait for CONNACK after sending CONNECT"""
+
+    def __init__(self, ws: ClientConnection, keepalive: int = 60):
+        self.ws = ws
+        self.keepalive = keepalive
+        self.connected_at = monotonic()
+        self._last_sent = monotonic()
+        self._next_packet_id = 0
+        self._pending: dict[int, asyncio.Future] = {}
+        self._outbox: asyncio.Queue[bytes] = asyncio.Queue()
+        self._inbox: asyncio.Queue = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+        self._window = asyncio.Semaphore(self.max_inflight)
+        self._publishes: set[asyncio.Task] = set()
+        self.publish_stats = Counter()
+        self.ack_latencies: deque[float] = deque(maxlen=1000)
+        self.session_present = False
+
+    @classmethod
+    async def connect(cls, signed_mqtt_url: str, client_id: str, user_agent: str = mysa_stuff.CLIENT_HEADERS['user-agent'],
+                      keepalive: int = 60, clean_session: bool = True) -> 'MqttConnection':
+        '''Open a WebSockets connection to a SigV4-signed MQTT URL, and send CONNECT and await CONNACK
+
+        With clean_session=False, the broker keeps the client's subscriptions (and queues QoS 1
+        messages) across disconnections; if it still has them, the connection's session_present
+        attribute will be True, and there is no need to subscribe again.'''
+        urlp = urlparse(signed_mqtt_url)
+        ws = await ws_connect(
+            urlp._replace(scheme='wss').geturl(),
+            # We get 426 errors without the Sec-WebSocket-Protocol header:
+            subprotocols=('mqtt',),
+            # Seemingly not necessary for the server, but Mysa official client adds all this:
+            origin=urlp._replace(path='', params='', query='', fragment='').geturl(),
+            additional_headers={'accept-encoding': 'gzip'},
+            user_agent_header=user_agent,
+        )
+        try:
+            await ws.send(mqttpacket.connect(client_id, keepalive) if clean_session else _persistent_connect(client_id, keepalive))
+            data = await asyncio.wait_for(ws.recv(), cls.connack_timeout)
+            pkt = mqttpacket.parse_one(data)
+            if not isinstance(pkt, mqttpacket.ConnackPacket):
+                raise websockets.exceptions.ProtocolError(f'Expected CONNACK, but received {pkt}')
+            # CONNACK is always 0x20 0x02 <flags> <return code>
+            if data[3] != 0:
+                raise ConnectionRefused(data[3])
+        except BaseException:
+            await ws.close()
+            raise
+
+        self = cls(ws, keepalive)
+        stats['connects'] += 1
+        # Bit 0 of the CONNACK flags is Session Present
+        self.session_present = not clean_session and bool(data[2] & 1)
+        self._tasks = [asyncio.create_task(self._reader()),
+                       asyncio.create_task(self._writer()),
+                       asyncio.create_task(self._pinger())]
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        for t in (*self._tasks, *self._publishes):
+            t.cancel()
+        await self.ws.close()
+
+    def packet_id(self) -> int:
+        '''Next packet ID (1-0x7fff) for SUBSCRIBE or QoS>0 PUBLISH packets, skipping any still awaiting acknowledgement'''
+        assert len(self._pending) < 0x7fff
+        while True:
+            self._next_packet_id = self._next_packet_id % 0x7fff + 1
+            if self._next_packet_id not in self._pending:
+                return self._next_packet_id
+
+    def send(self, pkt: bytes):
+        '''Queue a raw MQTT packet to be sent, without waiting'''
+        self._outbox.put_nowait(pkt)
+
+    async def publish(self, topic: str, payload: bytes, qos: int = 1, retain: bool = False) -> Optional[float]:
+        '''Send a PUBLISH packet. For QoS 1, wait for a slot in the in-flight window, and then for the
+        PUBACK, resending with the DUP flag if it doesn't arrive in time.
+
+        Returns the acknowledgement latency in seconds, or None for QoS 0.'''
+        if qos == 0:
+            self.send(mqttpacket.publish(topic, False, 0, retain, payload=payload))
+            self.publish_stats['sent'] += 1
+            return None
+        assert qos == 1, 'QoS 2 is not supported'
+
+        async with self._window:
+            pid = self.packet_id()
+            fut = self._pending[pid] = asyncio.get_running_loop().create_future()
+            started = monotonic()
+            try:
+                for attempt in range(self.max_retransmits + 1):
+                    self.send(mqttpacket.publish(topic, attempt > 0, 1, retain, packet_id=pid, payload=payload))
+                    self.publish_stats['retransmitted' if attempt else 'sent'] += 1
+                    try:
+                        await asyncio.wait_for(asyncio.shield(fut), self.retransmit_after)
+                        break
+                    except asyncio.TimeoutError:
+                        logger.debug(f'No PUBACK for packet_id={pid} to {topic} after {monotonic() - started:.1f}s')
+                else:
+                    self.publish_stats['unacked'] += 1
+                    raise TimeoutError(f'No PUBACK for packet_id={pid} to {topic} after {self.max_retransmits} retransmits')
+            finally:
+                self._pending.pop(pid, None)
+
+        self.ack_latencies.append(latency := monotonic() - started)
+        self.publish_stats['acked'] += 1
+        return latency
+
+    def publish_soon(self, topic: str, payload: bytes, qos: int = 1, retain: bool = False) -> asyncio.Task:
+        '''Like publish(), but in a background task, so that the caller need not wait'''
+        t = asyncio.create_task(self.publish(topic, payload, qos, retain))
+        self._publishes.add(t)
+        t.add_done_callback(self._publish_done)
+        return t
+
+    def _publish_done(self, t: asyncio.Task):
+        self._publishes.discard(t)
+        if not t.cancelled() and (exc := t.exception()):
+            logger.warning(f'Failed to publish: {exc!r}')
+
+    def publish_report(self) -> str:
+        '''Summary of publish() counts and acknowledgement latencies'''
+        st, lat = self.publish_stats, sorted(self.ack_latencies)
+        out = (f"{st['sent']} published, {st['acked']} acked, {st['retransmitted']} retransmitted, "
+               f"{st['unacked']} never acked, {len(self._pending)} awaiting ack")
+        if lat:
+            out += (f'; ack latency median {lat[len(lat) // 2] * 1e3:.0f} ms, '
+                    f'p95 {lat[int(len(lat) * 0.95)] * 1e3:.0f} ms, max {lat[-1] * 1e3:.0f} ms')
+        return out
+
+    async def subscribe(self, topics: Iterable[str], qos: int = 1) -> 'mqttpacket.SubackPacket':
+        '''Send a SUBSCRIBE packet and await its SUBACK'''
+        pid = self.packet_id()
+        fut = self._pending[pid] = asyncio.get_running_loop().create_future()
+        self.send(mqttpacket.subscribe(pid, [mqttpacket.SubscriptionSpec(t, qos) for t in topics]))
+        try:
+            return await fut
+        finally:
+            self._pending.pop(pid, None)
+
+    async def subscribe_devices(self, devices: Iterable[str], topics_per_packet: int = 3, window: int = 4):
+        '''Subscribe to the in/out/batch topics of each device.
+
+        AWS IoT core barfs if we subscribe to too many topics at once (where "too many" is something
+        like 10!!), so the topics are packed into SUBSCRIBE packets of at most topics_per_packet topics
+        (by default, one device's worth), with up to `window` of them awaiting SUBACK at once. Topics
+        refused by the broker are retried in smaller packets, down to one topic per packet.
+
+        Sometimes the broker drops the connection instead of refusing topics, in which case
+        websockets.exceptions.ConnectionClosed is raised, and the caller should reconnect and
+        retry with smaller_subscribe(topics_per_packet, window).'''
+        pending = deque(f'/v1/dev/{did}/{sub}' for did in devices for sub in ('out', 'in', 'batch'))
+        ntopics, failed = len(pending), []
+
+        async def worker():
+            nonlocal topics_per_packet
+            while pending:
+                chunk = [pending.popleft() for _ in range(min(topics_per_packet, len(pending)))]
+                suback = await self.subscribe(chunk)
+                refused = [t for t, rc in zip(chunk, suback.return_codes) if rc & 0x80]
+                if not refused:
+                    continue
+                elif len(chunk) == 1:
+                    failed.extend(refused)
+                else:
+                    # Back off to smaller packets, for these and all subsequent topics
+                    topics_per_packet = min(topics_per_packet, max(1, len(chunk) // 2))
+                    logger.debug(f'Broker refused {len(refused)}/{len(chunk)} topics, retrying {topics_per_packet} per SUBSCRIBE')
+                    pending.extendleft(reversed(refused))
+
+        started = monotonic()
+        await asyncio.gather(*(worker() for _ in range(window)))
+        logger.debug(f'Subscribed to {ntopics - len(failed)} topics in {monotonic() - started:.3f} s')
+        if failed:
+            raise RuntimeError(f'Broker refused subscription to {len(failed)} topic(s): {", ".join(failed)}')
+
+    @staticmethod
+    def smaller_subscribe(topics_per_packet: int, window: int) -> tuple[int, int]:
+        '''Smaller (topics_per_packet, window) for subscribe_devices to retry with, after the broker
+        dropped the connection while subscribing'''
+        if topics_per_packet > 1:
+            return topics_per_packet // 2, window
+        return 1, max(1, window // 2)
+
+    async def recv(self) -> 'mqttpacket._packet.MQTTPacket':
+        '''Next received packet that isn't part of the connection lifecycle (PUBLISH, PUBACK, DISCONNECT, etc).
+
+        Raises websockets.exceptions.ConnectionClosed once the connection is closed.'''
+        pkt = await self._inbox.get()
+        if isinstance(pkt, BaseException):
+            self._inbox.put_nowait(pkt)  # ... for any other waiters
+            raise pkt
+        return pkt
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.recv()
+
+    async def _reader(self):
+        try:
+            async for data in self.ws:
+                t = perf_counter()
+                pkt = mqttpacket.parse_one(data)
+                stages.record('parse_one', type(pkt).__name__, perf_counter() - t)
+                logger.debug(f'Received packet: {pkt}')
+                if isinstance(pkt, (mqttpacket.SubackPacket, mqttpacket._packet.PubackPacket)) and pkt.packet_id in self._pending:
+                    if not (fut := self._pending[pkt.packet_id]).done():
+                        fut.set_result(pkt)
+                elif isinstance(pkt, mqttpacket._packet.PingrespPacket):
+                    pass
+                else:
+                    self._inbox.put_nowait(pkt)
+            await self.ws.recv()  # raises ConnectionClosed, with details
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(exc)
+                    fut.exception()  # ... so that an unawaited one doesn't log "exception was never retrieved"
+            self._inbox.put_nowait(exc)
+
+    async def _writer(self):
+        while True:
+            pkt = await self._outbox.get()
+            t = perf_counter()
+            try:
+                await self.ws.send(pkt)
+            except websockets.exceptions.ConnectionClosed:
+                return  # reader will notice and report it
+            stages.record('ws.send', '(all)', perf_counter() - t)
+            self._last_sent = monotonic()
+
+    async def _pinger(self):
+        while True:
+            if (idle := monotonic() - self._last_sent) >= self.keepalive:
+                self.send(mqttpacket.pingreq())
+                stats['pingreqs'] += 1
+                logger.debug("Sent PINGREQ keepalive packet")
+                idle = 0
+            await asyncio.sleep(self.keepalive - idle)
+
+
+class MqttPool:
+    '''Devices partitioned across several MQTT connections ("shards"), each with its own
+    keepalive and reconnection, and with the packets received by all of them merged into
+    one stream, in order of arrival.
+
+    Spreads the load over several TCP streams, and keeps each connection under AWS IoT's
+    per-connection subscription and throughput limits.'''
+    SHARD_BY = ('count', 'hash')
+
+    def __init__(self, sign_url: Callable[[], str], client_id: str, devices: Iterable[str], shards: int = 1,
+                 shard_by: str = 'count', user_agent: str = mysa_stuff.CLIENT_HEADERS['user-agent'],
+                 keepalive: int = 60, topics_per_packet: int = 3, window: int = 4):
+        self.sign_url = sign_url
+        self.client_id = client_id
+        self.partitions = self.partition(devices, shards, shard_by)
+        self.user_agent = user_agent
+        self.keepalive = keepalive
+        self.topics_per_packet = topics_per_packet
+        self.window = window
+        self.shards: list[Optional[MqttConnection]] = [None] * len(self.partitions)
+        self._shard_of = {did: n for n, devs in enumerate(self.partitions) for did in devs}
+        self._inbox: asyncio.Queue = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+    @classmethod
+    def partition(cls, devices: Iterable[str], shards: int, shard_by: str = 'count') -> list[list[str]]:
+        '''Split devices into at most `shards` non-empty groups, either evenly by count (in order),
+        or by a hash of the device ID (so that a device stays on the same shard as others come and go)'''
+        devices = list(devices)
+        assert shards >= 1 and shard_by in cls.SHARD_BY
+        shards = min(shards, len(devices)) or 1
+        if shard_by == 'count':
+            q, r = divmod(len(devices), shards)
+            bounds = [n * q + min(n, r) for n in range(shards + 1)]
+            return [devices[bounds[n]:bounds[n + 1]] for n in range(shards)]
+        else:
+            parts = [[] for _ in range(shards)]
+            for did in devices:
+                parts[zlib.crc32(did.encode()) % shards].append(did)
+            return [p for p in parts if p]
+
+    async def start(self):
+        '''Connect and subscribe all shards, raising an exception if any of them fails the first time'''
+        loop = asyncio.get_running_loop()
+        ready = [loop.create_future() for _ in self.partitions]
+        self._tasks = [asyncio.create_task(self._run_shard(n, r)) for n, r in enumerate(ready)]
+        try:
+            await asyncio.gather(*ready)
+        except BaseException:
+            await self.close()
+            raise
+        return self
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def send(self, pkt: bytes, did: Optional[str] = None):
+        '''Queue a raw MQTT packet to be sent, on the shard for a specific device if given'''
+        self.shards[self._shard_of.get(did, 0)].send(pkt)
+
+    async def recv(self) -> tuple[MqttConnection, 'mqttpacket._packet.MQTTPacket']:
+        '''Next received packet from any shard, along with the connection that it arrived on (which is
+        the one that any PUBACK must be sent on)'''
+        return await self._inbox.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.recv()
+
+    async def _run_shard(self, n: int, ready: asyncio.Future):
+        devices, backoff = self.partitions[n], 1
+        topics_per_packet, window = self.topics_per_packet, self.window
+        while True:
+            conn, subscribing = None, False
+            try:
+                url = await asyncio.to_thread(self.sign_url)
+                conn = await MqttConnection.connect(url, f'{self.client_id}-{n}', self.user_agent, self.keepalive)
+                async with conn:
+                    subscribing = True
+                    await conn.subscribe_devices(devices, topics_per_packet, window)
+                    subscribing = False
+                    self.shards[n] = conn
+                    if ready.done():
+                        logger.info(f'MQTT shard {n} reconnected, with {len(devices)} devices')
+                        stats['reconnects'] += 1
+                    else:
+                        logger.debug(f'MQTT shard {n} connected, with {len(devices)} devices')
+                        ready.set_result(conn)
+                    backoff = 1
+                    async for pkt in conn:
+                        self._inbox.put_nowait((conn, pkt))
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                if subscribing and isinstance(exc, websockets.exceptions.ConnectionClosed) and (topics_per_packet > 1 or window > 1):
+                    # Keep subscribing in smaller packets after reconnecting, so that we don't get stuck
+                    topics_per_packet, window = MqttConnection.smaller_subscribe(topics_per_packet, window)
+                    logger.warning(f'MQTT shard {n} connection closed while subscribing, retrying with {topics_per_packet} '
+                                   f'topics per SUBSCRIBE and {window} at once in {backoff}s...')
+                    stats['subscribe_drops'] += 1
+                elif not ready.done():
+                    ready.set_exception(exc)
+                    return
+                elif conn and isinstance(exc, websockets.exceptions.ConnectionClosed):
+                    logger.warning(f'MQTT shard {n} connection closed after {int(monotonic() - conn.connected_at)}s '
+                                   f'(rcvd={exc.rcvd}, sent={exc.sent}), reconnecting in {backoff}s...')
+                else:
+                    logger.warning(f'MQTT shard {n} failed ({exc!r}), reconnecting in {backoff}s...')
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
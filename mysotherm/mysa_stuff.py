@@ -1,14 +1,16 @@
+from array import array
+from bisect import bisect_left
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 from datetime import datetime
 from time import time
 from functools import reduce
+from itertools import repeat
 import struct
+from urllib.parse import urlencode
+import zlib
 
-import botocore
-import requests
-
-from .aws import botocore
+from . import sigv4
 
 REGION = 'us-east-1'
 """Region for Mysa AWS infrastructure"""
@@ -58,7 +60,7 @@ BASE_URL = 'https://app-prod.mysa.cloud'
 
 
 def auther(u):
-    def f(request: requests.Request) -> requests.Request:
+    def f(request: 'requests.Request') -> 'requests.Request':
         if time() > u.id_claims['exp'] - 5:
             u.renew_access_token()  # despite the name, this also renews the id_token
 
@@ -70,7 +72,7 @@ def auther(u):
     return f
 
 
-def sigv4_sign_mqtt_url(cred: botocore.credentials.Credentials):
+def sigv4_sign_mqtt_url(cred: 'botocore.credentials.Credentials | sigv4.Credentials'):
     """
     Mysa is doing SigV4 in an odd (and potentially insecure) way!
 
@@ -100,13 +102,10 @@ def sigv4_sign_mqtt_url(cred: botocore.credentials.Credentials):
     the session token afterwards.
     """
 
-    req = botocore.awsrequest.AWSRequest('GET', MQTT_WS_URL)
-    botocore.auth.SigV4QueryAuth(
-        credentials=cred.get_frozen_credentials()._replace(token=None), # Strip the session token before signing
-        service_name='iotdevicegateway',
-        region_name='us-east-1').add_auth(req)
-    req.params['X-Amz-Security-Token'] = cred.token  # Plunk the session into the URL after signing
-    return req.prepare().url
+    frozen = cred.get_frozen_credentials() if hasattr(cred, 'get_frozen_credentials') else cred
+    url = sigv4.presign_url(MQTT_WS_URL, frozen._replace(token=None),  # Strip the session token before signing
+                            service='iotdevicegateway', region=REGION)
+    return url + '&' + urlencode({'X-Amz-Security-Token': frozen.token})  # Plunk the session into the URL after signing
 
 
 @dataclass
@@ -133,47 +132,136 @@ class MysaReading:
     checksum_good: bool
     unknown: Optional[bytes]  # Bytes before final checksum, overridden in child classes
 
+    # On-the-wire layout of the fields shared by all versions, following the 2-byte
+    # 0xcaa0 prefix and the version byte, as (name, struct format) pairs...
+    _wire_common = (
+        ('ts', 'L'), ('sensor_t', 'h'), ('ambient_t', 'h'), ('setpoint_t', 'h'),
+        ('humidity', 'b'), ('duty', 'b'), ('on_ms', 'h'), ('off_ms', 'h'),
+        ('heatsink_t', 'h'), ('free_heap', 'H'), ('rssi', 'b'), ('onoroff', 'b'),
+    )
+    # ... and the version-specific fields between those and the checksum byte
+    _wire_rest = ()
+    # Multiply on-the-wire values by the first number and divide them by the second to get
+    # the units of the dataclass fields
+    _wire_scale = {
+        'sensor_t': (1, 10), 'ambient_t': (1, 10), 'setpoint_t': (1, 10), 'heatsink_t': (1, 10),  # On-the-wire unit = 0.1°C
+        'on_ms': (100, 1), 'off_ms': (100, 1),                                                 # On-the-wire unit = 100 ms
+        'free_heap': (10, 1),                                                                  # On-the-wire unit = 10 (10 what??)
+        'rssi': (-1, 1),                                                                       # On-the-wire unit = -1 dBm
+        'current': (10, 1),                                                                    # On-the-wire unit = 10 mA
+    }
+
+    @classmethod
+    def _wire_fields(cls):
+        return (('magic', '2s'), ('ver', 'B')) + cls._wire_common + cls._wire_rest + (('checksum', 'B'),)
+
+    @classmethod
+    def _frame_struct(cls) -> struct.Struct:
+        return _frame_structs[cls]
+
+    @classmethod
+    def parse_readings_array(cls, readings: bytes):
+        '''Columnar alternative to parse_readings(), for batches of a known version (0, 1 or 3).
+
+        Decodes the whole batch in one pass into a NumPy structured array with one row per
+        reading, and the same field names and units as the dataclass. The unit conversions and
+        checksum validation are vectorized, and no per-reading Python objects are created.
+
+        Requires numpy.'''
+        import numpy as np
+
+        assert len(readings) >= 26
+        ver = readings[2]
+        if (_cls := _known_reading_vers.get(ver)) is None:
+            raise ValueError(f'Cannot decode readings of unknown version {ver} into an array')
+        _np_types = {'2s': 'S2', '3s': 'V3', 'B': 'u1', 'b': 'i1', 'H': '<u2', 'h': '<i2', 'L': '<u4'}
+        wire_dtype = np.dtype([(k, _np_types[f]) for k, f in _cls._wire_fields()])
+        assert len(readings) % wire_dtype.itemsize == 0, f'Readings length {len(readings)} is not a multiple of v{ver} size {wire_dtype.itemsize}'
+
+        wire = np.frombuffer(readings, dtype=wire_dtype)
+        assert (wire['magic'] == b'\xca\xa0').all()  # All should have same prefix
+        assert (wire['ver'] == ver).all()             # ... and same version
+
+        out = np.empty(len(wire), dtype=[
+            (k, 'f8' if _cls._wire_scale.get(k, (1, 1))[1] != 1 else 'V3' if f == '3s' else 'i8')
+            for k, f in _cls._wire_fields()[1:]] + [('checksum_good', '?')])
+        for k in out.dtype.names[:-1]:
+            out[k] = wire[k]
+            mul, div = _cls._wire_scale.get(k, (1, 1))
+            if mul != 1:
+                out[k] *= mul
+            if div != 1:
+                out[k] /= div
+        # XOR of all bytes in each reading, including its final checksum byte, should be zero
+        frames = np.frombuffer(readings, dtype=np.uint8).reshape(len(wire), wire_dtype.itemsize)
+        out['checksum_good'] = np.bitwise_xor.reduce(frames, axis=1) == 0
+        return out
+
     @classmethod
     def parse_readings(cls, readings: bytes) -> list['MysaReading']:
+        return list(cls.iter_readings(readings))
+
+    @classmethod
+    def iter_readings(cls, readings: bytes, since: Optional[int] = None, until: Optional[int] = None) -> Iterator['MysaReading']:
+        '''Lazily decode readings, one at a time, without copying the buffer.
+
+        If since and/or until are specified, only readings with since <= ts < until are
+        decoded. Readings are assumed to be in chronological order, so decoding stops at
+        the first reading with ts >= until.'''
         global _known_reading_vers
+        buf = memoryview(readings)
         offset = 0
-        assert len(readings) >= 26
-        ver = readings[2]
-        output = []
-        while offset < len(readings):
+        assert len(buf) >= 26
+        ver = buf[2]
+        if (_cls := _known_reading_vers.get(ver)) is None:
+            data = bytes(readings)  # memoryview can't .find()
+        while offset < len(buf):
             _start = offset
-            assert readings[offset: offset+2] == b'\xca\xa0' # All should have same prefix
-            assert readings[offset+2] == ver                 # ... and same version
+            assert buf[offset: offset+2] == b'\xca\xa0'   # All should have same prefix
+            assert buf[offset+2] == ver                 # ... and same version
             offset += 3
-            sts, sens, amb, setp, hum, duty, onish, offish, heatsink, heap, rssi, onoroff = struct.unpack_from('<LhhhbbhhhHbb', readings, offset)
-            offset += 22
+            if _cls and since is not None and _ts_struct.unpack_from(buf, offset)[0] < since:
+                offset = _start + _cls._size           # Skip without decoding
+                continue
+            sts, sens, amb, setp, hum, duty, onish, offish, heatsink, heap, rssi, onoroff = _common_struct.unpack_from(buf, offset)
+            if until is not None and sts >= until:
+                return
+            offset += _common_struct.size
             heap *= 10                                          # On-the-wire unit = 10 (10 what??)
             sens /= 10; amb /= 10; setp /= 10; heatsink /= 10   # On-the-wire unit = 0.1°C
             rssi = -rssi                                        # On-the-wire-unit = -1 dBm
             onish *= 100; offish *= 100                         # On-the-wire-unit = 100 ms
-            args = [sts, sens, amb, setp, hum, duty, onish, offish, heatsink, heap, rssi, onoroff]
 
-            if _cls := _known_reading_vers.get(ver):
-                rest, offset = _cls._unpack_rest(readings, offset)
+            if _cls:
+                rest, offset = _cls._unpack_rest(buf, offset)
                 unknown = None
             else:
                 # Find the start of the next reading for an *unknown* version. Hopefully there are
                 # no inadvertent matching bytes!!
-                if (end := readings.find(bytes((0xca, 0xa0, ver)), offset + 1)) < 0:
-                    end = len(readings)
-                unknown = readings[offset: end-1] if end > offset + 1 else None
-                _cls = cls
+                if (end := data.find(bytes((0xca, 0xa0, ver)), offset + 1)) < 0:
+                    end = len(buf)
+                unknown = bytes(buf[offset: end-1]) if end > offset + 1 else None
+                rest, offset = {}, max(offset, end-1)
 
-            csum = readings[offset]
+            csum = buf[offset]
             offset += 1
-            csum_good = reduce(int.__xor__, readings[_start: offset]) == 0
+            csum_good = reduce(int.__xor__, buf[_start: offset]) == 0
+            if since is not None and sts < since:
+                continue
 
-            output.append(_cls(
+            yield (_cls or cls)(
                 ver=ver, ts=sts, sensor_t=sens, ambient_t=amb, setpoint_t=setp, humidity=hum, duty=duty,
                 on_ms=onish, off_ms=offish, heatsink_t=heatsink, free_heap=heap, rssi=rssi, onoroff=onoroff,
-                unknown=unknown, checksum=csum, checksum_good=csum_good, **rest))
+                unknown=unknown, checksum=csum, checksum_good=csum_good, **rest)
             #assert bytes(reading) == readings[_start: offset], f'\n{bytes(reading)} != \n{readings[_start: offset]}'
-        return output
+
+    @classmethod
+    def last_reading(cls, readings: bytes) -> 'MysaReading':
+        '''Decode only the last reading in the buffer (if its version is known).'''
+        if (_cls := _known_reading_vers.get(readings[2])) is not None:
+            return next(cls.iter_readings(memoryview(readings)[-_cls._size:]))
+        *_, last = cls.iter_readings(readings)
+        return last
 
     def _pack_rest(self):
         return self.unknown or b''
@@ -207,6 +295,8 @@ class MysaReadingV0(MysaReading):
 
     This version is used by the thermostat with model number BB-V1-1 ("Mysa Baseboard V1"),
     and maybe others.'''
+    _size = 26
+
     @classmethod
     def _unpack_rest(cls, readings: bytes, offset):
         return {}, offset
@@ -219,13 +309,17 @@ class MysaReadingV1(MysaReading):
     and maybe others.'''
     voltage: int      # Unit = 1 V
 
+    _wire_rest = (('voltage', 'h'),)
+    _rest_struct = struct.Struct('<h')
+    _size = 28
+
     @classmethod
     def _unpack_rest(cls, readings: bytes, offset):
-        voltage, = struct.unpack_from('<h', readings, offset)
+        voltage, = cls._rest_struct.unpack_from(readings, offset)
         return {'voltage': voltage}, offset + 2
 
     def _pack_rest(self):
-        return struct.pack('<h', self.voltage)
+        return self._rest_struct.pack(self.voltage)
 
     def __str__(self):
         return super().__str__() + f' | v1: voltage={self.voltage}V'
@@ -241,14 +335,18 @@ class MysaReadingV3(MysaReading):
     current: int      # Unit = 1 mA
     always0: bytes    # Unknown 3 bytes, seemingly always zero
 
+    _wire_rest = (('voltage', 'h'), ('current', 'h'), ('always0', '3s'))
+    _rest_struct = struct.Struct('<hh3s')
+    _size = 33
+
     @classmethod
     def _unpack_rest(cls, readings: bytes, offset):
-        voltage, current, always0 = struct.unpack_from('<hh3s', readings, offset)
+        voltage, current, always0 = cls._rest_struct.unpack_from(readings, offset)
         current *= 10                           # On-the-wire unit = 10 mA
         return {'voltage': voltage, 'current': current, 'always0': always0}, offset + 7
 
     def _pack_rest(self):
-        return struct.pack('<hh3s', self.voltage,
+        return self._rest_struct.pack(self.voltage,
             self.current // 10,  # On-the-wire unit = 10 mA
             self.always0)
 
@@ -256,8 +354,250 @@ class MysaReadingV3(MysaReading):
         return super().__str__() + f' | v3: voltage={self.voltage}V, cur={self.current}mA, zero?={self.always0.hex()}'
 
 
+_ts_struct = struct.Struct('<L')
+_common_struct = struct.Struct('<LhhhbbhhhHbb')
+
 _known_reading_vers = {
     0: MysaReadingV0,
     1: MysaReadingV1,
     3: MysaReadingV3,
 }
+
+# Precompiled structs for complete on-the-wire readings of each known version
+_frame_structs = {c: struct.Struct('<' + ''.join(f for k, f in c._wire_fields())) for c in _known_reading_vers.values()}
+
+
+def _xor_bytes(b: bytes) -> int:
+    # XOR of all bytes of a <=32-byte buffer, by folding it as one big integer
+    x = int.from_bytes(b, 'little')
+    x ^= x >> 128; x &= (1 << 128) - 1
+    x ^= x >> 64; x &= (1 << 64) - 1
+    x ^= x >> 32; x &= 0xffffffff
+    x ^= x >> 16; x ^= x >> 8
+    return x & 0xff
+
+
+def transcode_readings_v3_to_v0(readings: bytes) -> bytearray:
+    '''Rewrite a batch of v3 readings (BB-V2-0/BB-V2-0-L) as v0 readings (BB-V1-1) at the byte level.
+
+    The first 25 bytes of each v3 reading are identical to those of a v0 reading except for the
+    version byte, so we copy them into a preallocated buffer, patch the version byte, drop the 7
+    trailing v3-only bytes, and recompute the XOR checksum.'''
+    size0, size3 = MysaReadingV0._size, MysaReadingV3._size
+    n, extra = divmod(len(readings), size3)
+    assert n and not extra, f'Readings length {len(readings)} is not a multiple of v3 size {size3}'
+    src = memoryview(readings)
+    out = bytearray(n * size0)
+    for o, s in zip(range(0, len(out), size0), range(0, len(src), size3)):
+        assert src[s: s+3] == b'\xca\xa0\x03'
+        out[o: o+size0-1] = src[s: s+size0-1]
+        out[o+2] = 0
+        out[o+size0-1] = _xor_bytes(out[o: o+size0-1])
+    return out
+
+
+class ReadingBatch:
+    '''Compact, column-wise container for a batch of readings, all of the same (known) version.
+
+    Each on-the-wire field is stored in its own array.array, in its on-the-wire units, so a
+    reading takes about as much memory as it does on the wire (26-33 bytes), and the batch
+    round-trips exactly to the wire format via bytes(). MysaReading objects are created only
+    when individual rows are accessed.
+
+    For comparison, measured with tracemalloc on CPython 3.11, 2000 v3 readings take:
+      - list of MysaReadingV3 from parse_readings(): ~1.14 MB (~570 bytes/reading)
+      - ReadingBatch:                                ~62 kB (~31 bytes/reading)
+    '''
+    __slots__ = ('ver', '_cls', '_cols')
+
+    _array_types = {'B': 'B', 'b': 'b', 'H': 'H', 'h': 'h', 'L': 'I'}
+
+    def __init__(self, ver: int, cols: dict):
+        if (_cls := _known_reading_vers.get(ver)) is None:
+            raise ValueError(f'Cannot store readings of unknown version {ver} in a ReadingBatch')
+        self.ver = ver
+        self._cls = _cls
+        self._cols = cols
+
+    @classmethod
+    def from_bytes(cls, readings: bytes) -> 'ReadingBatch':
+        assert len(readings) >= 26
+        ver = readings[2]
+        if (_cls := _known_reading_vers.get(ver)) is None:
+            raise ValueError(f'Cannot store readings of unknown version {ver} in a ReadingBatch')
+        assert len(readings) % _cls._size == 0, f'Readings length {len(readings)} is not a multiple of v{ver} size {_cls._size}'
+        cols = dict(zip((k for k, f in _cls._wire_fields()), zip(*_cls._frame_struct().iter_unpack(readings))))
+        assert set(cols.pop('magic', ())) <= {b'\xca\xa0'}  # All should have same prefix
+        assert set(cols.pop('ver', ())) <= {ver}            # ... and same version
+        return cls(ver, {k: (b''.join(cols[k]) if f == '3s' else array(cls._array_types[f], cols[k]))
+                         for k, f in _cls._wire_fields()[2:]})
+
+    @classmethod
+    def from_readings(cls, readings: Iterable[MysaReading]) -> 'ReadingBatch':
+        return cls.from_bytes(b''.join(bytes(r) for r in readings))
+
+    @property
+    def ts(self) -> array:
+        '''Timestamps of all readings (Unix time, seconds)'''
+        return self._cols['ts']
+
+    @property
+    def nbytes(self) -> int:
+        '''Size of the column buffers, in bytes'''
+        return sum(len(c) * getattr(c, 'itemsize', 1) for c in self._cols.values())
+
+    def column(self, name: str) -> list:
+        '''All values of one field, in the same units as the MysaReading field of that name'''
+        mul, div = self._cls._wire_scale.get(name, (1, 1))
+        col = self._cols[name]
+        if name == 'always0':
+            return [col[n: n+3] for n in range(0, len(col), 3)]
+        elif div != 1:
+            return [v * mul / div for v in col]
+        elif mul != 1:
+            return [v * mul for v in col]
+        return col.tolist()
+
+    def between(self, since: Optional[int] = None, until: Optional[int] = None) -> 'ReadingBatch':
+        '''Readings with since <= ts < until. Readings are assumed to be in chronological order.'''
+        return self[(0 if since is None else bisect_left(self.ts, since)):
+                    (len(self) if until is None else bisect_left(self.ts, until))]
+
+    def __len__(self):
+        return len(self._cols['ts'])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('ReadingBatch slices must be contiguous')
+            return ReadingBatch(self.ver, {k: (c[start*3: stop*3] if k == 'always0' else c[start: stop])
+                                           for k, c in self._cols.items()})
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('ReadingBatch index out of range')
+        return next(self._cls.iter_readings(self._frame(index)))
+
+    def __iter__(self):
+        return self._cls.iter_readings(bytes(self))
+
+    def __bytes__(self):
+        frame = self._cls._frame_struct()
+        return b''.join(frame.pack(*row) for row in zip(*self._rows()))
+
+    def _frame(self, index: int) -> bytes:
+        return self._cls._frame_struct().pack(b'\xca\xa0', self.ver, *(
+            c[index*3: index*3+3] if k == 'always0' else c[index] for k, c in self._cols.items()))
+
+    def _rows(self):
+        # Columns in on-the-wire order, with the constant prefix and version re-inserted
+        cols = [repeat(b'\xca\xa0'), repeat(self.ver)]
+        for k, c in self._cols.items():
+            cols.append([c[i: i+3] for i in range(0, len(c), 3)] if k == 'always0' else c)
+        return cols
+
+    def __repr__(self):
+        return f'<ReadingBatch v{self.ver}, {len(self)} readings, {self.nbytes} bytes>'
+
+
+# Compact column-wise encoding of readings, for long-term storage and transfer.
+#
+# Format: b'MYZ\x01', reading version byte, varint count, then each on-the-wire field
+# (except the constant prefix and version) as a column of varints:
+#   - 'delta' columns: first value, then successive differences (zig-zag varints)
+#   - 'rle' columns: (zig-zag value, run length) varint pairs
+#   - the checksum column is stored as the XOR of the actual checksum with the correct
+#     one (so it is almost always a single run of zeroes, but bad checksums round-trip)
+# ... and finally the whole thing is zlib-compressed.
+
+_CODEC_MAGIC = b'MYZ\x01'
+_codec_rle_fields = {'setpoint_t', 'duty', 'onoroff', 'voltage', 'always0', 'checksum'}
+
+
+def _write_varint(out: bytearray, n: int):
+    n = (n << 1) if n >= 0 else ((-n << 1) - 1)  # zig-zag
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(buf: bytes, pos: int):
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            break
+        shift += 7
+    return ((n >> 1) if not n & 1 else -((n + 1) >> 1)), pos
+
+
+def encode_readings(readings: bytes) -> bytes:
+    '''Losslessly compress a batch of readings (all of the same known version).'''
+    batch = ReadingBatch.from_bytes(readings)
+    frame = batch._cls._frame_struct()
+    out = bytearray(_CODEC_MAGIC)
+    out.append(batch.ver)
+    _write_varint(out, len(batch))
+    for k, f in batch._cls._wire_fields()[2:]:
+        if k == 'always0':
+            col = [int.from_bytes(v, 'little') for v in batch.column(k)]
+        elif k == 'checksum':
+            col = [cs ^ _xor_bytes(readings[o: o+frame.size-1])
+                   for cs, o in zip(batch._cols[k], range(0, len(readings), frame.size))]
+        else:
+            col = batch._cols[k]
+        if k in _codec_rle_fields:
+            prev, run = col[0], 0
+            for v in col:
+                if v == prev:
+                    run += 1
+                else:
+                    _write_varint(out, prev); _write_varint(out, run)
+                    prev, run = v, 1
+            _write_varint(out, prev); _write_varint(out, run)
+        else:
+            prev = 0
+            for v in col:
+                _write_varint(out, v - prev)
+                prev = v
+    return zlib.compress(out, 9)
+
+
+def decode_readings(data: bytes) -> bytes:
+    '''Decompress readings compressed with encode_readings(), back to their exact on-the-wire bytes.'''
+    buf = zlib.decompress(data)
+    if buf[:len(_CODEC_MAGIC)] != _CODEC_MAGIC:
+        raise ValueError('Not a compressed batch of readings')
+    ver = buf[len(_CODEC_MAGIC)]
+    if (_cls := _known_reading_vers.get(ver)) is None:
+        raise ValueError(f'Cannot decode readings of unknown version {ver}')
+    n, pos = _read_varint(buf, len(_CODEC_MAGIC) + 1)
+    cols = {}
+    for k, f in _cls._wire_fields()[2:]:
+        col = []
+        if k in _codec_rle_fields:
+            while len(col) < n:
+                v, pos = _read_varint(buf, pos)
+                run, pos = _read_varint(buf, pos)
+                col.extend(repeat(v, run))
+        else:
+            v = 0
+            for _ in range(n):
+                d, pos = _read_varint(buf, pos)
+                v += d
+                col.append(v)
+        if k == 'always0':
+            cols[k] = b''.join(v.to_bytes(3, 'little') for v in col)
+        else:
+            cols[k] = array(ReadingBatch._array_types[f], col)
+
+    # Stored checksums are relative to the correct ones
+    out = bytearray(bytes(ReadingBatch(ver, cols)))
+    size = _cls._size
+    for o in range(size - 1, len(out), size):
+        out[o] ^= _xor_bytes(out[o-size+1: o])
+    return bytes(out)
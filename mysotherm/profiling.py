@@ -0,0 +1,124 @@
+'''
+Lightweight timing of the stages of handling each received MQTT packet (parsing the
+packet, parsing the JSON payload, classifying the message, parsing readings, formatting
+output, and sending), aggregated per stage and message type into fixed-bucket histograms.
+
+Sending SIGUSR1 to the process dumps the tables to stderr. With --profile, cProfile and
+tracemalloc are also enabled for the long-running loop, and each dump also shows the
+hottest functions and the biggest growth in allocations since the previous dump.
+'''
+import asyncio
+from bisect import bisect_left
+import cProfile
+import io
+import os
+import pstats
+import signal
+from sys import stderr
+from time import perf_counter
+import tracemalloc
+from typing import Optional
+
+BUCKETS_US = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 100000)
+"""Upper bounds of the histogram buckets, in µs (plus an overflow bucket)"""
+
+
+class StageHistograms:
+    def __init__(self):
+        self._hists: dict[tuple[str, str], list] = {}   # (stage, key) -> [bucket counts, total s, max s]
+
+    def record(self, stage: str, key: str, seconds: float):
+        if (h := self._hists.get((stage, key))) is None:
+            h = self._hists[stage, key] = [[0] * (len(BUCKETS_US) + 1), 0.0, 0.0]
+        h[0][bisect_left(BUCKETS_US, seconds * 1e6)] += 1
+        h[1] += seconds
+        if seconds > h[2]:
+            h[2] = seconds
+
+    @staticmethod
+    def _percentile(counts: list[int], q: float, max_us: float) -> float:
+        target, cumulative = q * sum(counts), 0
+        for bound, n in zip(BUCKETS_US, counts):
+            cumulative += n
+            if cumulative >= target:
+                return min(bound, max_us)
+        return max_us
+
+    def report(self) -> str:
+        if not self._hists:
+            return '(no timings recorded)'
+        keyw = max(len(key) for _, key in self._hists)
+        stagew = max(len(stage) for stage, _ in self._hists)
+        lines = [f'{"stage":{stagew}} {"message type":{keyw}} {"count":>8} {"mean µs":>9} {"p50 µs":>9} {"p99 µs":>9} {"max µs":>9}']
+        for (stage, key), (counts, total, mx) in sorted(self._hists.items()):
+            n = sum(counts)
+            lines.append(f'{stage:{stagew}} {key:{keyw}} {n:8} {total / n * 1e6:9.1f} {self._percentile(counts, 0.5, mx * 1e6):9.0f} '
+                         f'{self._percentile(counts, 0.99, mx * 1e6):9.0f} {mx * 1e6:9.0f}')
+        lines.append(f'(p50/p99 are bucket upper bounds: {", ".join(map(str, BUCKETS_US))} µs)')
+        return '\n'.join(lines)
+
+
+stages = StageHistograms()
+
+
+class Stopwatch:
+    '''Times consecutive stages of handling one packet, which are recorded (under
+    the message type, which may only be known at the end) by done()'''
+    __slots__ = ('t', 'laps')
+
+    def __init__(self):
+        self.t = perf_counter()
+        self.laps = []
+
+    def lap(self, stage: str):
+        t = perf_counter()
+        self.laps.append((stage, t - self.t))
+        self.t = t
+
+    def done(self, key: str):
+        for stage, seconds in self.laps:
+            stages.record(stage, key, seconds)
+
+
+_profile: Optional[cProfile.Profile] = None
+_snapshot: Optional[tracemalloc.Snapshot] = None
+
+
+def dump(file=stderr):
+    '''Print the stage timings (and, if profiling, the cProfile stats and allocation growth since the last dump)'''
+    global _profile, _snapshot
+    print(f'Packet handling stage timings (pid {os.getpid()}):', file=file)
+    print(stages.report(), file=file)
+
+    if _profile is not None:
+        _profile.disable()
+        s = io.StringIO()
+        pstats.Stats(_profile, stream=s).sort_stats('cumulative').print_stats(25)
+        print('cProfile since last dump (top 25 cumulative):', s.getvalue(), sep='\n', file=file)
+        _profile = cProfile.Profile()
+        _profile.enable()
+
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        if _snapshot is None:
+            top, what = snapshot.statistics('lineno')[:15], 'largest allocations'
+        else:
+            top, what = snapshot.compare_to(_snapshot, 'lineno')[:15], 'allocation growth since last dump'
+        print(f'tracemalloc, {what}:', *(f'  {stat}' for stat in top), sep='\n', file=file)
+        _snapshot = snapshot
+
+
+def install(profile: bool = False):
+    '''Optionally start cProfile and tracemalloc (before starting the event loop)'''
+    global _profile
+    if profile:
+        tracemalloc.start()
+        _profile = cProfile.Profile()
+        _profile.enable()
+
+
+def dump_on_signal():
+    '''Dump timings on SIGUSR1. Must be called from within the running event loop, which
+    then runs dump() between callbacks, rather than in the middle of whatever it interrupted.'''
+    if hasattr(signal, 'SIGUSR1'):   # not on Windows
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, dump)
@@ -0,0 +1,109 @@
+'''
+Requeries of device state from Mysa's JSON API, triggered by MQTT messages which
+indicate that a device's state has changed (or is about to).
+
+Triggers arrive in bursts (a device will often send several such messages at once,
+and many devices dump their readings at about the same time), so the requeries are
+debounced per device, and coalesced into a single query for all devices when several
+are due at once. They run in their own task, so that they never hold up the handling
+of received MQTT messages.
+'''
+import asyncio
+from collections import Counter
+import logging
+from time import time
+from typing import Callable, Iterable, Optional
+
+import requests
+
+from .mysa_stuff import BASE_URL
+from .util import slurpy
+
+logger = logging.getLogger(__name__)
+
+
+class RecheckScheduler:
+    settle = 1.0
+    """Seconds to wait after a recheck is due, in case more triggers for the same or other devices follow"""
+
+    max_postpone = 10.0
+    """Repeated triggers for a device can postpone its pending recheck by at most this many seconds"""
+
+    bulk_threshold = 3
+    """Query all device states at once (GET /devices/state) when at least this many devices are due"""
+
+    timeout = 10
+    """Seconds to wait for each JSON API request"""
+
+    def __init__(self, sess: requests.Session, states: slurpy, on_update: Optional[Callable[[list[str]], None]] = None):
+        self.sess = sess
+        self.states = states
+        self.on_update = on_update
+        self._pending: dict[str, list[float]] = {}   # did -> [originally due, due]
+        self._wake = asyncio.Event()
+        self.stats = Counter()
+
+    def request(self, did: str, at: float):
+        '''Recheck the state of a device at (or soon after) time `at`. Cheap enough to call
+        for every received message.'''
+        self.stats['triggers'] += 1
+        at += self.settle
+        if (p := self._pending.get(did)) is not None:
+            self.stats['debounced'] += 1
+            p[1] = min(max(p[1], at), p[0] + self.max_postpone)
+        else:
+            self._pending[did] = [at, at]
+            self._wake.set()
+
+    def report(self) -> str:
+        s = self.stats
+        return (f"{s['triggers']} triggers ({s['debounced']} debounced), {s['rechecked']} devices rechecked "
+                f"with {s['requests']} requests ({s['bulk_requests']} bulk, {s['failed']} failed), "
+                f"{s['triggers'] - s['requests'] - len(self._pending)} requests saved")
+
+    async def run(self):
+        while True:
+            now = time()
+            if not (due := [did for did, (_, at) in self._pending.items() if at <= now]):
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), min((at for _, at in self._pending.values()), default=now + 3600) - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for did in due:
+                del self._pending[did]
+            print(f'Requerying state of {len(due)} device(s) from JSON API...')
+            if updated := await (self._recheck_all(due) if len(due) >= self.bulk_threshold else self._recheck_each(due)):
+                self.stats['rechecked'] += len(updated)
+                if self.on_update:
+                    self.on_update(updated)
+            logger.debug(f'Device state rechecks: {self.report()}')
+
+    async def _get(self, path: str, key: str):
+        '''Get one key of a JSON API response, or None (after logging why) if the request fails'''
+        self.stats['requests'] += 1
+        try:
+            r = await asyncio.to_thread(self.sess.get, f'{BASE_URL}{path}', timeout=self.timeout)
+            r.raise_for_status()
+            return r.json(object_hook=slurpy)[key]
+        except (requests.RequestException, ValueError, KeyError) as exc:
+            self.stats['failed'] += 1
+            logger.error(f"Request for device state failed: {exc!r}")
+
+    async def _recheck_each(self, dids: Iterable[str]) -> list[str]:
+        updated = []
+        for did, state in zip(dids, await asyncio.gather(*(self._get(f'/devices/state/{did}', 'DeviceState') for did in dids))):
+            if state is not None:
+                self.states[did] = state
+                updated.append(did)
+        return updated
+
+    async def _recheck_all(self, dids: Iterable[str]) -> list[str]:
+        self.stats['bulk_requests'] += 1
+        if (states := await self._get('/devices/state', 'DeviceStatesObj')) is None:
+            return []
+        # Everything is fresher now, but only report on the devices which were due
+        self.states.update(states)
+        return [did for did in dids if did in states]
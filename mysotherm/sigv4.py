@@ -0,0 +1,110 @@
+'''
+Minimal, self-contained implementation of AWS Signature Version 4, for the handful of
+AWS calls that we need, so that we don't have to create (slow, heavyweight) boto3 clients.
+
+Produces exactly the same output as botocore.auth.SigV4QueryAuth (presigned URLs)
+and botocore.auth.SigV4Auth (signed headers), for services other than S3 (which,
+unlike all the others, doesn't percent-encode the already-escaped path a second time
+in the canonical request).
+
+https://docs.aws.amazon.com/IAM/latest/UserGuide/reference_sigv-create-signed-request.html
+'''
+from collections import namedtuple
+from datetime import datetime, timezone
+from hashlib import sha256
+import hmac
+from typing import Optional
+from urllib.parse import quote, urlsplit, urlunsplit
+
+Credentials = namedtuple('Credentials', 'access_key secret_key token')
+"""Same fields as botocore.credentials.ReadOnlyCredentials"""
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+
+
+class AwsError(Exception):
+    '''Error response from an AWS API'''
+    def __init__(self, code: str, message: str, status: Optional[int] = None):
+        super().__init__(f'{code}: {message}')
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+def _quote(s) -> str:
+    return quote(str(s), safe='-_.~')
+
+
+def _signature(secret_key: str, date: str, region: str, service: str, string_to_sign: str) -> str:
+    k = ('AWS4' + secret_key).encode()
+    for part in (date, region, service, 'aws4_request'):
+        k = hmac.new(k, part.encode(), sha256).digest()
+    return hmac.new(k, string_to_sign.encode(), sha256).hexdigest()
+
+
+def _canonical_uri(path: str) -> str:
+    # Same as botocore.auth.SigV4Auth._normalize_url_path: remove dot segments and
+    # repeated slashes, then percent-encode the (already-escaped) path again
+    segments = []
+    for seg in path.split('/'):
+        if seg == '..':
+            if segments:
+                segments.pop()
+        elif seg and seg != '.':
+            segments.append(seg)
+    normalized = '/'.join(segments)
+    if path.startswith('/'):
+        normalized = '/' + normalized
+    if path.endswith('/') and segments:
+        normalized += '/'
+    return quote(normalized or '/', safe='/~')
+
+
+def _canonical_request(method: str, urlp, canonical_query: str, headers: dict, body: bytes):
+    # headers must already be lowercased
+    signed = ';'.join(sorted(headers))
+    canonical_headers = ''.join(f'{k}:{" ".join(str(headers[k]).split())}\n' for k in sorted(headers))
+    return signed, '\n'.join((method.upper(), _canonical_uri(urlp.path), canonical_query, canonical_headers, signed, sha256(body).hexdigest()))
+
+
+def presign_url(url: str, cred: Credentials, service: str, region: str, expires: int = 3600,
+                now: Optional[datetime] = None) -> str:
+    '''SigV4 "query string" presigning of a GET request for a URL without a query string'''
+    now = (now or datetime.now(timezone.utc)).strftime('%Y%m%dT%H%M%SZ')
+    urlp = urlsplit(url)
+    assert not urlp.query
+    scope = f'{now[:8]}/{region}/{service}/aws4_request'
+    params = {
+        'X-Amz-Algorithm': ALGORITHM,
+        'X-Amz-Credential': f'{cred.access_key}/{scope}',
+        'X-Amz-Date': now,
+        'X-Amz-Expires': expires,
+        'X-Amz-SignedHeaders': 'host',
+    }
+    if cred.token is not None:
+        params['X-Amz-Security-Token'] = cred.token
+    query = '&'.join(f'{_quote(k)}={_quote(v)}' for k, v in params.items())
+    canonical_query = '&'.join(sorted(query.split('&')))
+    _, creq = _canonical_request('GET', urlp, canonical_query, {'host': urlp.netloc}, b'')
+    string_to_sign = '\n'.join((ALGORITHM, now, scope, sha256(creq.encode()).hexdigest()))
+    sig = _signature(cred.secret_key, now[:8], region, service, string_to_sign)
+    return urlunsplit(urlp._replace(query=query)) + f'&X-Amz-Signature={sig}'
+
+
+def sign_headers(method: str, url: str, cred: Credentials, service: str, region: str,
+                 headers: Optional[dict] = None, body: bytes = b'', now: Optional[datetime] = None) -> dict:
+    '''SigV4 signing of a request via the Authorization header. Returns the headers to send.'''
+    now = (now or datetime.now(timezone.utc)).strftime('%Y%m%dT%H%M%SZ')
+    urlp = urlsplit(url)
+    headers = {k.lower(): v for k, v in (headers or {}).items()}
+    headers.update({'host': urlp.netloc, 'x-amz-date': now})
+    if cred.token is not None:
+        headers['x-amz-security-token'] = cred.token
+    scope = f'{now[:8]}/{region}/{service}/aws4_request'
+    canonical_query = '&'.join(sorted(f'{k}={v}' for k, _, v in (p.partition('=') for p in urlp.query.split('&') if p)))
+    signed, creq = _canonical_request(method, urlp, canonical_query, headers, body)
+    string_to_sign = '\n'.join((ALGORITHM, now, scope, sha256(creq.encode()).hexdigest()))
+    sig = _signature(cred.secret_key, now[:8], region, service, string_to_sign)
+    headers['authorization'] = f'{ALGORITHM} Credential={cred.access_key}/{scope}, SignedHeaders={signed}, Signature={sig}'
+    del headers['host']
+    return headers
@@ -0,0 +1,110 @@
+'''
+Local model ("digital twin") of the current state of each device, kept up to date from
+the MQTT messages that devices publish, and queryable over a local HTTP/JSON API.
+
+Mysa's JSON API (GET /devices/state) is laggy compared to the MQTT messages (see
+mysa_messages.md; e.g. its Duty lags well behind the devices' dtyCycle), so the twin is
+seeded from the JSON API, and each field is then updated from whichever source has the
+newest value for it. Fields are named as in /devices/state, and each is stored as
+{"v": value, "t": timestamp} in the same way.
+'''
+import json
+from time import time
+from typing import Any, Iterable, Iterator, Optional
+
+from . import messages
+from .util import serve_http, slurpy
+
+# Message fields -> /devices/state fields, for each message class (see mysa_messages.md)
+LEGACY_STATUS_FIELDS = {'ComboTemp': 'SensorTemp', 'MainTemp': 'CorrectedTemp', 'Humidity': 'Humidity',
+                        'SetPoint': 'SetPoint', 'Current': 'InstantCurrent'}
+"""MsgType 0 (BB-V1-1). Its Current is "the current right now", not /devices/state's highest current seen."""
+
+STATUS_BODY_FIELDS = {'ambTemp': 'CorrectedTemp', 'dtyCycle': 'Duty', 'hum': 'Humidity', 'stpt': 'SetPoint',
+                      'flrSnsrTemp': 'Infloor', 'trackedSnsr': 'TrackedSensor', 'currLnVolt': 'LineVoltage'}
+"""msg 40/17/16 body (BB-V2-0, BB-V2-0-L, INF-V1-0)"""
+
+STATUS_TOP_FIELDS = {'heatStat': 'Duty', 'lineVtg': 'LineVoltage'}
+"""msg 17 top-level fields (INF-V1-0)"""
+
+COMMAND_STATE_FIELDS = {'sp': 'SetPoint', 'md': 'TstatMode', 'lk': 'Lock', 'tr': 'TrackedSensor'}
+"""msg 44 response body.state. Not 'br', which is sometimes a dict of brightness settings rather than /devices/state's scalar Brightness."""
+
+
+def _sources(m: messages.Message):
+    if isinstance(m, messages.LegacyStatus):
+        yield m.rest, LEGACY_STATUS_FIELDS
+    elif isinstance(m, messages.Status):
+        yield m.body, STATUS_BODY_FIELDS
+        yield m.rest, STATUS_TOP_FIELDS
+    elif isinstance(m, messages.CommandResponse):
+        yield m.body.get('state', {}), COMMAND_STATE_FIELDS
+
+
+def state_fields(m: messages.Message) -> Iterator[tuple[str, Any]]:
+    '''(/devices/state field name, value) pairs for the device state reported in a decoded message'''
+    for j, fields in _sources(m):
+        for k, name in fields.items():
+            if k in j:
+                yield name, j[k]
+
+
+class DeviceTwin:
+    def __init__(self):
+        self._state: dict[str, dict[str, dict]] = {}
+
+    def _set(self, did: str, field: str, v, t: float) -> bool:
+        fields = self._state.setdefault(did, {})
+        if (old := fields.get(field)) is not None and old['t'] > t:
+            return False
+        fields[field] = {'v': v, 't': t}
+        return True
+
+    def update(self, m: messages.Message, received: Optional[float] = None) -> int:
+        '''Update from a decoded MQTT message, returning the number of fields updated.
+
+        Some messages have no (or a zero) timestamp, so they're treated as current as
+        of when they were received.'''
+        t = m.ts or received or time()
+        return sum(self._set(m.did, name, v, t) for name, v in state_fields(m))
+
+    def merge_states(self, states: dict, fetched: Optional[float] = None):
+        '''Update from (some of) the output of GET /devices/state (or /devices/state/$DID), keeping
+        any fields for which we already have newer values'''
+        fetched = fetched or time()
+        for did, s in states.items():
+            for k, vd in s.items():
+                if k == 'Device':
+                    continue
+                elif not isinstance(vd, dict):
+                    self._set(did, k, vd, fetched)  # sometimes a bare value, without timestamp
+                else:
+                    self._set(did, k, vd['v'], vd['t'] / 1000 if vd['t'] > 1000<<30 else vd['t'])  # sometimes ms
+
+    def get(self, did: str) -> Optional[dict]:
+        return self._state.get(did)
+
+    def snapshot(self, dids: Optional[Iterable[str]] = None) -> slurpy:
+        '''Copy of the state of some or all devices, in the same form as GET /devices/state (for print_device_states)'''
+        return slurpy((did, slurpy({k: slurpy(vd) for k, vd in self._state[did].items()}, Device=did))
+                      for did in (self._state if dids is None else dids) if did in self._state)
+
+    def to_json(self, did: Optional[str] = None) -> Optional[bytes]:
+        if did is None:
+            return json.dumps(self._state).encode()
+        elif (s := self._state.get(did)) is not None:
+            return json.dumps(s).encode()
+
+
+async def serve(twin: DeviceTwin, address: str) -> 'asyncio.AbstractServer':
+    '''Serve the twin's state over HTTP, on HOST:PORT or on a Unix socket (if address contains a "/").
+
+    GET /devices gives the state of all devices, and GET /devices/$DID of one.'''
+    def respond(path):
+        if path in ('', '/devices'):
+            return '200 OK', 'application/json', twin.to_json()
+        elif path.startswith('/devices/') and (body := twin.to_json(path[9:])) is not None:
+            return '200 OK', 'application/json', body
+        return '404 Not Found', 'application/json', b'{"error": "404 Not Found"}'
+
+    return await serve_http(address, respond, 'device state')
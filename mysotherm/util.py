@@ -1,3 +1,9 @@
+from contextlib import contextmanager
+import importlib.util
+import sys
+from time import perf_counter
+from types import ModuleType
+
 # Quacks like a dict and an object
 # (from https://github.com/dlenski/wtf/blob/master/wtf.py#L10C1-L19C1)
 class slurpy(dict):
@@ -10,3 +16,95 @@ class slurpy(dict):
             raise AttributeError(*e.args) from e
     def __setattr__(self, k, v):
         self[k]=v
+
+
+def lazy_import(name: str) -> ModuleType:
+    '''Import a module on first attribute access, rather than now.
+
+    Used for heavy modules which are only needed on some code paths (e.g. websockets
+    and asyncio are only needed for MQTT), to keep startup fast. Note that any parent
+    packages of a dotted name are imported immediately.'''
+    if (mod := sys.modules.get(name)) is not None:
+        return mod
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[name] = mod
+    spec.loader.exec_module(mod)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, mod)
+    return mod
+
+
+class StageTimer:
+    '''Records wall-clock start/end times of named, possibly-concurrent stages,
+    and renders them as a timeline to show which ones are on the critical path.'''
+    def __init__(self):
+        self.t0 = perf_counter()
+        self.stages = []
+
+    @contextmanager
+    def __call__(self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, start - self.t0, perf_counter() - self.t0))
+
+    def report(self, width: int = 40) -> str:
+        if not self.stages:
+            return ''
+        total = max(end for _, _, end in self.stages)
+        namew = max(len(name) for name, _, _ in self.stages)
+        lines = []
+        # Walk backwards from the last stage to finish: the latest-finishing stage that
+        # ended before each critical stage started is the one that held it up.
+        critical, t = set(), total
+        for name, start, end in sorted(self.stages, key=lambda s: -s[2]):
+            if end <= t + 1e-3:
+                critical.add(name)
+                t = start
+        for name, start, end in sorted(self.stages, key=lambda s: s[1]):
+            a, b = int(start / total * width), max(int(end / total * width), int(start / total * width) + 1)
+            lines.append(f'{"*" if name in critical else " "} {name:{namew}} {start*1e3:8.1f} ms +{(end-start)*1e3:8.1f} ms |{" "*a}{"#"*(b-a)}{" "*(width-b)}|')
+        lines.append(f'  {"(total)":{namew}} {total*1e3:8.1f} ms  (* = critical path)')
+        return '\n'.join(lines)
+
+
+async def serve_http(address: str, respond, name: str = 'HTTP'):
+    '''Minimal HTTP/1.1 server for local read-only APIs, on HOST:PORT or on a Unix socket (if address contains a "/").
+
+    respond(path) returns (status, content type, body) for a GET request of a path (without
+    any query string or trailing slash). Each connection handles a single request.'''
+    import asyncio
+    import logging
+    logger = logging.getLogger(__name__)
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass  # ignore headers
+            method, path, *_ = request.decode('latin-1').split()
+            if method != 'GET':
+                status, ctype, body = '405 Method Not Allowed', 'text/plain', b'Method Not Allowed\n'
+            else:
+                status, ctype, body = respond(path.split('?', 1)[0].rstrip('/'))
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\n'
+                         'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (ValueError, ConnectionError) as exc:
+            logger.debug(f'Bad {name} request: {exc!r}')
+        finally:
+            writer.close()
+
+    if '/' in address:
+        server = await asyncio.start_unix_server(handle, address)
+    else:
+        host, _, port = address.rpartition(':')
+        server = await asyncio.start_server(handle, host or 'localhost', int(port))
+    logger.info(f'Serving {name} at {address}')
+    return server
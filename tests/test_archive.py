@@ -0,0 +1,51 @@
+'''mysotherm.archive must survive torn writes (a crash in the middle of an append)'''
+import os
+
+import pytest
+
+from benchmarks.synthetic import readings_batch
+from mysotherm.archive import ReadingsArchive
+
+DID = 'aabbccddeeff'
+
+
+@pytest.fixture
+def archive(tmp_path):
+    arc = ReadingsArchive(str(tmp_path))
+    batch = readings_batch(3, 40)
+    assert arc.append(DID, batch) == 40
+    seg, = {os.path.join(tmp_path, DID, n[:-4]) for n in os.listdir(tmp_path / DID)}
+    return str(tmp_path), seg, batch
+
+
+def test_torn_trailing_record(archive):
+    root, seg, batch = archive
+    size = len(batch) // 40
+    # The last 5 readings were written to the .bin (the last one only partly), but not to the .idx
+    os.truncate(seg + '.idx', 35 * 4 + 2)
+    with open(seg + '.bin', 'ab') as f:
+        f.write(batch[:size // 2])
+
+    assert len(ReadingsArchive(root).query(DID)) == 35
+
+    arc = ReadingsArchive(root)   # as after restarting
+    assert arc.append(DID, batch) == 0
+    assert [bytes(r) for r in arc.query(DID)] == [batch[n:n + size] for n in range(0, len(batch), size)]
+    assert os.path.getsize(seg + '.bin') == len(batch)
+    assert os.path.getsize(seg + '.idx') == 40 * 4
+
+
+@pytest.mark.parametrize('how', ['empty', 'missing'])
+def test_empty_index(archive, how):
+    root, seg, batch = archive
+    if how == 'empty':
+        open(seg + '.idx', 'wb').close()
+    else:
+        os.remove(seg + '.idx')
+
+    assert ReadingsArchive(root).query(DID) == []
+
+    arc = ReadingsArchive(root)
+    assert arc.append(DID, readings_batch(3, 10, start=1736800000)) == 10
+    assert arc.append(DID, batch) == 0
+    assert len(arc.query(DID)) == 50
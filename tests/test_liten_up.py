@@ -0,0 +1,57 @@
+'''liten-up's translation of msg 44 commands'''
+import json
+
+import pytest
+
+mqttpacket = pytest.importorskip('mqttpacket.v311')
+
+from mysotherm import liten_up, messages
+
+DID, USER = 'aabbccddeeff', '0f1e2d3c-4b5a-6978-8796-a5b4c3d2e1f0'
+TOPIC = f'/v1/dev/{DID}/in'
+
+
+class FakeConnection:
+    def __init__(self):
+        self.published, self.sent = [], []
+
+    def publish_soon(self, topic, payload, qos=1, retain=False):
+        self.published.append((topic, json.loads(payload)))
+
+    def send(self, pkt):
+        self.sent.append(pkt)
+
+
+def command(type: int = 1, **extra) -> dict:
+    return {'Timestamp': 1792195900, 'body': {'cmd': [{'sp': 17, 'tm': -1}], 'type': type, 'ver': 1},
+            'dest': {'ref': DID, 'type': 1}, 'id': 1792195900123, 'msg': 44, 'resp': 2,
+            'src': {'ref': USER, 'type': 100}, 'time': 1792195900, 'ver': '1.0', **extra}
+
+
+def translate(payload: dict) -> FakeConnection:
+    conn = FakeConnection()
+    pkt = mqttpacket.parse_one(mqttpacket.publish(TOPIC, False, 1, False, packet_id=5, payload=json.dumps(payload).encode()))
+    liten_up.translate_packet(conn, pkt, 10.0, {})
+    assert len(conn.sent) == 1   # PUBACK
+    return conn
+
+
+@pytest.mark.parametrize('strict', [True, False], ids=['strict', 'lenient'])
+def test_translate_command(strict):
+    if strict:
+        payload = command()
+        assert isinstance(messages.decode(DID, 'in', payload), messages.Command)
+    else:
+        # Unexpected extra field, and Timestamp too far from id: messages.Command rejects this
+        payload = command(Timestamp=1792195905, extra=1)
+        with pytest.raises(AssertionError):
+            messages.decode(DID, 'in', payload)
+
+    (topic, out), = translate(payload).published
+    assert topic == TOPIC
+    assert out['body'] == dict(payload['body'], type=5)
+    assert out['time'] == out['Timestamp'] == out['id'] // 1000
+
+
+def test_dont_translate_translated_command():
+    assert not translate(command(type=5)).published
@@ -0,0 +1,93 @@
+'''mysotherm.mqtt against a minimal local MQTT-over-WebSockets broker'''
+import asyncio
+
+import pytest
+
+mqttpacket = pytest.importorskip('mqttpacket.v311')
+from websockets.asyncio.server import serve
+
+from mysotherm import mqtt
+
+
+@pytest.fixture(autouse=True)
+def no_tls(monkeypatch):
+    # MqttConnection.connect always uses wss://, but the test broker doesn't do TLS
+    orig = mqtt.ws_connect
+    monkeypatch.setattr(mqtt, 'ws_connect', lambda url, **kw: orig(url.replace('wss://', 'ws://', 1), **kw))
+
+
+async def broker(handler) -> tuple[str, 'asyncio.Server']:
+    server = await serve(handler, 'localhost', 0, subprotocols=['mqtt'])
+    return f'wss://localhost:{server.sockets[0].getsockname()[1]}/mqtt', server
+
+
+def test_connack_refused():
+    async def handler(ws):
+        await ws.recv()
+        await ws.send(b'\x20\x02\x00\x05')   # CONNACK: not authorized
+
+    async def main():
+        url, server = await broker(handler)
+        async with server:
+            with pytest.raises(mqtt.ConnectionRefused) as exc:
+                await mqtt.MqttConnection.connect(url, 'test')
+        assert exc.value.return_code == 5
+
+    asyncio.run(main())
+
+
+def test_connack_timeout(monkeypatch):
+    monkeypatch.setattr(mqtt.MqttConnection, 'connack_timeout', 0.1)
+
+    async def handler(ws):
+        async for _ in ws:
+            pass   # never CONNACK
+
+    async def main():
+        url, server = await broker(handler)
+        async with server:
+            with pytest.raises(asyncio.TimeoutError):
+                await mqtt.MqttConnection.connect(url, 'test')
+
+    asyncio.run(main())
+
+
+def test_connack_session_present():
+    async def handler(ws):
+        await ws.recv()
+        await ws.send(b'\x20\x02\x01\x00')
+        await ws.wait_closed()
+
+    async def main():
+        url, server = await broker(handler)
+        async with server:
+            async with await mqtt.MqttConnection.connect(url, 'test', clean_session=False) as conn:
+                assert conn.session_present
+
+    asyncio.run(main())
+
+
+def test_resubscribe_smaller_after_drop():
+    subscribes, devices = [], [f'{n:012x}' for n in range(8)]
+
+    async def handler(ws):
+        await ws.recv()
+        await ws.send(b'\x20\x02\x00\x00')
+        async for data in ws:
+            if isinstance(pkt := mqttpacket.parse_one(data), mqttpacket._packet.SubscribePacket):
+                subscribes.append(len(pkt.topics))
+                if len(pkt.topics) > 3:
+                    return   # like AWS IoT, drop the connection rather than refusing the topics
+                await ws.send(mqttpacket.suback(pkt.packet_id, [1] * len(pkt.topics)))
+
+    async def main():
+        url, server = await broker(handler)
+        async with server:
+            async with mqtt.MqttPool(lambda: url, 'test', devices, topics_per_packet=12, window=2):
+                pass
+
+    asyncio.run(asyncio.wait_for(main(), 10))
+    # Dropped at 12 and then 6 topics per SUBSCRIBE, and then subscribed to everything 3 at a time
+    assert set(subscribes[:-8]) == {12, 6} and subscribes[-8:] == [3] * 8
+    assert mqtt.MqttConnection.smaller_subscribe(3, 4) == (1, 4)
+    assert mqtt.MqttConnection.smaller_subscribe(1, 4) == (1, 2)
@@ -0,0 +1,60 @@
+'''mysotherm.recheck must keep rechecking after JSON API requests fail'''
+import asyncio
+from time import time
+
+import pytest
+import requests
+
+from mysotherm import recheck
+from mysotherm.util import slurpy
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def get(self, url, **kwargs):
+        self.calls.append((url, kwargs))
+        r = self.responses.pop(0)
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+
+def response(status: int, body: bytes) -> requests.Response:
+    r = requests.Response()
+    r.status_code, r._content = status, body
+    return r
+
+
+@pytest.mark.parametrize('failure', [
+    requests.ConnectionError('nope'),
+    requests.Timeout('too slow'),
+    response(200, b'{"SomethingElse": {}}'),
+    response(200, b'<html>not JSON</html>'),
+    response(503, b'{"message": "Service Unavailable"}'),
+], ids=['raises', 'timeout', 'missing key', 'not JSON', 'HTTP error'])
+def test_recheck_survives_failure(failure):
+    sess = FakeSession(failure, response(200, b'{"DeviceState": {"SetPoint": {"v": 20, "t": 1}}}'))
+    states, updated = slurpy(), []
+
+    async def main():
+        rs = recheck.RecheckScheduler(sess, states, updated.extend)
+        rs.settle = 0
+        task = asyncio.create_task(rs.run())
+        rs.request('aabbccddeeff', time())
+        while not rs.stats['failed']:
+            await asyncio.sleep(0.01)
+        rs.request('aabbccddeeff', time())
+        while not updated:
+            assert not task.done()
+            await asyncio.sleep(0.01)
+        task.cancel()
+        return rs
+
+    rs = asyncio.run(asyncio.wait_for(main(), 5))
+    assert updated == ['aabbccddeeff']
+    assert states['aabbccddeeff'].SetPoint.v == 20
+    assert rs.stats['failed'] == 1 and rs.stats['requests'] == 2
+    assert all(kw.get('timeout') for _, kw in sess.calls)